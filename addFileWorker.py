@@ -31,16 +31,21 @@ import os
 from time import sleep
 import stomp
 
-from aflib3 import AFLibrary, AFMongoDataStore
+from aflib3 import AFLibrary, AFMongoDataStore, AFBufferedWriter
 from afmq import AddFileHandler
 
 def main():
-	AddFileHandler(AFLibrary(AFMongoDataStore()))
+	datastore = AFMongoDataStore()
+	lib = AFLibrary(datastore, AFBufferedWriter(datastore, 200, 2000))
+	handler = AddFileHandler(lib)
 	try:
 		while (True):
 			sleep(1)
+			lib.writer.flush_expired()
 	except KeyboardInterrupt:
 		pass
+	handler.close()
+	print lib.writer
 		
 if __name__ == '__main__':
 	main()
@@ -47,27 +47,30 @@ class AFLibrary:
 		('publisher.name', 'publisher'),
 		('genre.name', 'genre')
 	]
+	schema_tables = ['publisher', 'genre', 'artist', 'album', 'song']
 	def __init__(self):
 		self.dbname = expanduser('~/.audiofile/lib.db')
 		if not isdir(dirname(self.dbname)):
 			makedirs(dirname(self.dbname))
 		con = sql.connect(self.dbname)
-		# Figure out if we have the schema yet
+		# Figure out if we have the schema yet.  A library made by
+		# aflib2 or aflib3 has more tables (its search index), so
+		# look for ours by name.
 		cur = con.cursor()
-		cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table'")
-		count = cur.fetchone()[0]
-		nTables = 5
-		if count != nTables:
+		cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+		names = set([row[0] for row in cur.fetchall()])
+		if not names.issuperset(self.schema_tables):
 			self.clear_db(con)
 		self.create_db(con)
 		con.close()
 			
 	def clear_db(self, con):
 		cur = con.cursor()
-		cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+		# Virtual tables go first; dropping one drops its shadow tables
+		cur.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY sql LIKE 'CREATE VIRTUAL%' DESC")
 		rows = cur.fetchall()
 		for row in rows:
-			cur.execute('DROP TABLE %s' % row[0])
+			cur.execute('DROP TABLE IF EXISTS %s' % row[0])
 		con.commit()
 			
 	def create_db(self, con):
@@ -109,6 +112,16 @@ class AFLibrary:
 			w = 'AND'
 		return sql
 		
+	def update_paths(self, moves):
+		'''Points each song at the new path in moves, a list of
+		(old path, new path) pairs for files which were renamed.'''
+		con = sql.connect(self.dbname)
+		cur = con.cursor()
+		cur.executemany('UPDATE song SET path=? WHERE path=?',
+						[(new, old) for old, new in moves])
+		con.commit()
+		con.close()
+
 	def get_songs(self, qdict):
 		sqlstmt = self.make_sql_from_query(qdict)
 		con = sql.connect(self.dbname)
@@ -27,15 +27,30 @@ THE SOFTWARE.
 """
 
 import sys
-from os import makedirs
+import re
+import unicodedata
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left
+from itertools import islice, chain
+from os import makedirs, stat
 from os.path import isfile, isdir, dirname, expanduser
 import eyed3
+import eyed3.id3
+from afutils import id3v2, file_pattern
 import sqlite3 as sql
+from threading import Thread, Lock, local
+from Queue import Queue, Empty
+from multiprocessing import Pool
+from time import time
 
 class AFDataStore:
 	'''Abstract base class representing a datastore
 	for an audiofile library.
+	generation is bumped by every write, so anything cached from
+	the datastore can tell when it has gone stale.
 	'''
+	generation = 0
 	query_fields = [
 		('song.name', 'title'),
 		('song.path', 'path'),
@@ -48,117 +63,530 @@ class AFDataStore:
 		('album.year', 'year'),
 		('artist.name', 'artist'),
 		('publisher.name', 'publisher'),
-		('genre.name', 'genre')
+		('genre.name', 'genre'),
+		('song.id', 'id')
 	]
 	def create_db(self):
 		raise NotImplementedError
 	def save_mp3(self,entry):
 		raise NotImplementedError
-	def get_query_result_set(self,qdict):
+	def save_mp3_batch(self,entries,errors=None):
+		'''Saves the entries and returns how many were saved.  An
+		entry which can't be saved doesn't stop the others: with
+		errors, a list, an (entry, exception) pair is appended to
+		it for each failure, and without it the first exception is
+		raised once the rest are saved.'''
+		saved = 0
+		failed = []
+		for entry in entries:
+			try:
+				self.save_mp3(entry)
+				saved += 1
+			except Exception as e:
+				failed.append((entry, e))
+		return self._report_failures(saved,failed,errors)
+	def _report_failures(self,saved,failed,errors):
+		if errors is not None:
+			errors.extend(failed)
+		elif failed:
+			raise failed[0][1]
+		return saved
+	def get_query_result_set(self,qdict,batch_size=1000,order_by=None,limit=None,offset=None,after=None):
+		'''Returns an iterator over the songs matching qdict,
+		fetched from the datastore batch_size at a time.
+		order_by is a list of AFLibraryEntry.row_fields names, each
+		prefixed with "-" for descending order; the song's id is
+		always the last key so the order is total, and any of the
+		paging arguments sorts by id alone when there is no order_by.
+		limit and offset page through the results, and after
+		resumes them following the song whose get_page_key() it
+		is, which stays fast however deep the page.'''
+		raise NotImplementedError
+	def get_entries(self,qdict,batch_size=1000,order_by=None,limit=None,offset=None,after=None):
+		'''Returns an iterator over the songs matching qdict as
+		AFLibraryEntry instances.'''
+		for result in self.get_query_result_set(qdict,batch_size,
+						order_by=order_by,limit=limit,offset=offset,after=after):
+			yield AFLibraryEntry.from_dict(result)
+	def _get_order(self,order_by):
+		'''Returns the (field, descending) pairs for order_by.'''
+		order = []
+		for name in order_by or []:
+			field = name.lstrip('-')
+			if field not in AFLibraryEntry.row_fields:
+				raise ValueError('Unknown order field "%s"' % field)
+			order.append((field, name.startswith('-')))
+		# Paths needn't be unique (a deleted song can share one with
+		# a live one), so ids break the ties
+		if 'id' not in [field for field, descending in order]:
+			order.append(('id', False))
+		return order
+	def get_page_key(self,song,order_by=None):
+		'''Returns the key to pass as after= to get the songs
+		which follow song, a result or AFLibraryEntry from a query
+		with the same order_by.'''
+		if isinstance(song, dict):
+			return tuple([song[field] for field, descending in self._get_order(order_by)])
+		return tuple([getattr(song, field) for field, descending in self._get_order(order_by)])
+	def get_file_fingerprints(self,base_path):
+		raise NotImplementedError
+	def delete_paths(self,paths):
+		raise NotImplementedError
+	def update_paths(self,moves):
+		'''Points each song at the new path in moves, a list of
+		(old path, new path) pairs for files which were renamed.'''
+		raise NotImplementedError
+	def aggregate(self,group_by,qdict=None,distinct=None):
+		'''Counts the songs matching qdict for each value of the
+		group_by field (or combination of values, for a list of
+		fields), or with distinct set, the number of different
+		values of that field among them, e.g. albums per artist.
+		Returns a list of dictionaries holding the group_by fields
+		and the count, largest count first.  Albums are told apart
+		by artist as well as name.'''
+		raise NotImplementedError
+	def _get_aggregate_fields(self,group_by,distinct):
+		if isinstance(group_by, basestring):
+			group_by = [group_by]
+		for field in list(group_by) + [distinct]:
+			if field is not None and (field not in AFLibraryEntry.row_fields or field == 'id'):
+				raise ValueError('Unknown aggregate field "%s"' % field)
+		if not group_by:
+			raise ValueError('Nothing to group by')
+		return list(group_by)
+	def search(self,text,limit=50):
+		'''Returns an iterator over up to limit songs whose title,
+		artist or album match the words in text, best match first.'''
 		raise NotImplementedError
 		
+class AFIdCache:
+	'''Thread-safe, LRU-bounded cache mapping names to row ids.
+	Tracks hits and misses so the cache size can be tuned.
+	'''
+	def __init__(self,max_size=10000):
+		self.max_size = max_size
+		self.entries = OrderedDict()
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+	def get(self,key):
+		with self.lock:
+			try:
+				row_id = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self.entries[key] = row_id
+			self.hits += 1
+			return row_id
+	def put(self,key,row_id):
+		with self.lock:
+			self.entries.pop(key,None)
+			self.entries[key] = row_id
+			if len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+	def __str__(self):
+		return 'ID cache: %d entries, %d hits, %d misses' % \
+			(len(self.entries), self.hits, self.misses)
+
+class AFQueryCache:
+	'''Thread-safe, LRU-bounded cache of query results for
+	AFLibrary.get_songs(), keyed on the normalized query.  An
+	entry is dropped once it is ttl seconds old or the datastore's
+	generation has moved on since it was cached, and result sets
+	of more than max_rows songs are never cached.  Tracks hits,
+	misses and why entries were dropped.
+	'''
+	def __init__(self,max_size=100,ttl=60,max_rows=10000):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.max_rows = max_rows
+		self.entries = OrderedDict()
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+		self.expired = 0
+		self.invalidated = 0
+	@staticmethod
+	def make_key(qdict):
+		if not qdict:
+			return ()
+		return tuple(sorted([(k.strip('\'').strip('"'), v.strip('\'').strip('"'))
+						for k, v in qdict.items()]))
+	def get(self,key,generation):
+		with self.lock:
+			try:
+				cached_generation, expires, songs = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			if cached_generation != generation:
+				self.invalidated += 1
+				self.misses += 1
+				return None
+			if time() >= expires:
+				self.expired += 1
+				self.misses += 1
+				return None
+			self.entries[key] = (cached_generation, expires, songs)
+			self.hits += 1
+			return songs
+	def put(self,key,generation,songs):
+		with self.lock:
+			self.entries.pop(key,None)
+			self.entries[key] = (generation, time() + self.ttl, songs)
+			if len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+	def hit_rate(self):
+		if self.hits + self.misses:
+			return float(self.hits) / (self.hits + self.misses)
+		return 0.0
+	def __str__(self):
+		return 'Query cache: %d entries, %d hits, %d misses (%.1f%% hit rate), %d invalidated, %d expired' % \
+			(len(self.entries), self.hits, self.misses, self.hit_rate() * 100,
+			self.invalidated, self.expired)
+
 class AFSqliteDataStore(AFDataStore):
 	'''Implementation of AFDataStore which stores
 	the audiofile library in SQLite.
 	'''
+	# Applied to every connection as it is opened
+	pragmas = [
+		'journal_mode=WAL',
+		'synchronous=NORMAL',
+		'cache_size=-65536',
+		'mmap_size=268435456'
+	]
+	query_joins = [
+		('album', 'song.album_id=album.id'),
+		('artist', 'song.artist_id=artist.id AND album.artist_id=artist.id'),
+		('genre', 'song.genre_id=genre.id'),
+		('publisher', 'album.publisher_id=publisher.id')
+	]
+	schema_tables = ['publisher', 'genre', 'artist', 'album', 'song']
+	# The column aggregate() groups and counts each field on, and
+	# the table to look the name up in where that column is an id.
+	# Names are unique in artist, genre and publisher, so counting
+	# their ids counts the names; albums are counted by id because
+	# the same album name can belong to several artists.
+	aggregate_columns = {
+		'title': ('song.name', None),
+		'path': ('song.path', None),
+		'base_path': ('song.base_path', None),
+		'track_num': ('song.track_num', None),
+		'disc_num': ('song.disc_num', None),
+		'artist': ('song.artist_id', 'artist'),
+		'genre': ('song.genre_id', 'genre'),
+		'album': ('song.album_id', 'album'),
+		'publisher': ('album.publisher_id', 'publisher'),
+		'year': ('album.year', None),
+		'total_tracks': ('album.track_count', None),
+		'total_discs': ('album.disc_count', None)
+	}
+	song_file_columns = [
+		('size', 'INTEGER'),
+		('mtime', 'REAL'),
+		('inode', 'INTEGER'),
+		('deleted', 'INTEGER DEFAULT 0')
+	]
+	def __init__(self,id_cache_size=10000,dbname='~/.audiofile/lib.db'):
+		self.dbname = expanduser(dbname)
+		self.id_cache = AFIdCache(id_cache_size)
+		# Each thread reads through its own connection; all writes
+		# go through a single writer connection, one at a time.
+		self.local = local()
+		self.connections = []
+		self.connections_lock = Lock()
+		self.writer_conn = None
+		self.write_lock = Lock()
+		self.have_search_index = None
+		self.upgrade_lock = Lock()
+		self.upgraded = False
+	def _connect(self):
+		self._upgrade()
+		dbconn = sql.connect(self.dbname,check_same_thread=False)
+		for pragma in self.pragmas:
+			dbconn.execute('PRAGMA %s' % pragma)
+		with self.connections_lock:
+			self.connections.append(dbconn)
+		return dbconn
+	def _upgrade(self):
+		# A library made by an older version gets the newer columns
+		# and indexes before anything reads or writes it, rather
+		# than only when create_db() is run.
+		with self.upgrade_lock:
+			if self.upgraded:
+				return
+			self.upgraded = True
+			if not isfile(self.dbname):
+				return
+			dbconn = sql.connect(self.dbname)
+			try:
+				cur = dbconn.cursor()
+				cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+				names = set([row[0] for row in cur.fetchall()])
+				if names.issuperset(self.schema_tables):
+					self._create_schema(dbconn)
+			finally:
+				dbconn.close()
 	def _get_connection(self):
-		self.dbname = expanduser('~/.audiofile/lib.db')
-		return sql.connect(self.dbname)
+		dbconn = getattr(self.local, 'dbconn', None)
+		if dbconn is None:
+			dbconn = self._connect()
+			self.local.dbconn = dbconn
+		return dbconn
+	def _get_writer_connection(self):
+		# Only call with write_lock held
+		if self.writer_conn is None:
+			self.writer_conn = self._connect()
+		return self.writer_conn
+	def close(self):
+		'''Closes every connection the datastore has opened.'''
+		with self.connections_lock:
+			for dbconn in self.connections:
+				dbconn.close()
+			self.connections = []
+		self.local = local()
+		self.writer_conn = None
 	def _have_schema(self):
-		# Figure out if we have the schema yet
-		dbconn = self._get_connection()
-		cur = dbconn.cursor()
-		cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table'")
-		count = cur.fetchone()[0]
-		dbconn.close()
-		return count == 5
-	def _clear_db(self):
+		# Figure out if we have the schema yet.  The search index
+		# brings tables of its own, so look for ours by name.
 		dbconn = self._get_connection()
 		cur = dbconn.cursor()
 		cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-		rows = cur.fetchall()
-		for row in rows:
-			cur.execute('DROP TABLE %s' % row[0])
-		dbconn.commit()
-		dbconn.close()		
+		# Read every row: a half-read cursor keeps the reader on an
+		# old snapshot of the database
+		names = set([row[0] for row in cur.fetchall()])
+		cur.close()
+		return names.issuperset(self.schema_tables)
+	def _clear_db(self):
+		with self.write_lock:
+			dbconn = self._get_writer_connection()
+			cur = dbconn.cursor()
+			# Virtual tables go first; dropping one drops its shadow tables
+			cur.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY sql LIKE 'CREATE VIRTUAL%' DESC")
+			rows = cur.fetchall()
+			for row in rows:
+				cur.execute('DROP TABLE IF EXISTS %s' % row[0])
+			dbconn.commit()
+			self.id_cache.clear()
+			self.have_search_index = None
+			self.generation += 1		
 	def _get_or_create_id(self,table,name,dbconn):
 		if name and len(name):
+			row_id = self.id_cache.get((table,name))
+			if row_id is not None:
+				return row_id
 			cur = dbconn.cursor()
 			try:
-				cur.execute("INSERT INTO %s(name) VALUES ('%s')" % (table,name))
-				dbconn.commit()
+				cur.execute("INSERT INTO %s(name) VALUES (?)" % table, (name,))
 				row_id = cur.lastrowid
 			except sql.IntegrityError:
-				cur.execute("SELECT id FROM %s WHERE name='%s' LIMIT 1" % (table,name))
+				cur.execute("SELECT id FROM %s WHERE name=? LIMIT 1" % table, (name,))
 				row_id = cur.fetchone()[0]
+			self.id_cache.put((table,name),row_id)
 			return row_id
 		return None
 	def _get_or_create_album_id(self,album,artist_id,total_tracks,total_discs,publisher_id,year,dbconn):
 		if album and len(album):
+			row_id = self.id_cache.get(('album',album,artist_id))
+			if row_id is not None:
+				return row_id
 			cur = dbconn.cursor()
 			try:
 				cur.execute("INSERT INTO album(name,artist_id,track_count,disc_count,publisher_id,year) VALUES (?,?,?,?,?,?)", (album,artist_id,total_tracks,total_discs,publisher_id,year,))
-				dbconn.commit()
 				row_id = cur.lastrowid
 			except sql.IntegrityError:
 				cur.execute("SELECT id FROM album WHERE name=? AND artist_id=? LIMIT 1", (album,artist_id,))
 				row_id = cur.fetchone()[0]
+			self.id_cache.put(('album',album,artist_id),row_id)
 			return row_id
 		return None
-	def _get_or_create_song_id(self,song,path,base_path,album_id,artist_id,genre_id,track_num,disc_num,dbconn):
+	def _get_or_create_song_id(self,song,path,base_path,album_id,artist_id,genre_id,track_num,disc_num,size,mtime,inode,dbconn):
 		if song and len(song):
 			cur = dbconn.cursor()
 			try:
-				cur.execute("INSERT INTO song(name,path,base_path,album_id,artist_id,genre_id,track_num,disc_num) VALUES (?,?,?,?,?,?,?,?)", (song,path,base_path,album_id,artist_id,genre_id,track_num,disc_num,))
-				dbconn.commit()
+				cur.execute("INSERT INTO song(name,path,base_path,album_id,artist_id,genre_id,track_num,disc_num,size,mtime,inode) VALUES (?,?,?,?,?,?,?,?,?,?,?)", (song,path,base_path,album_id,artist_id,genre_id,track_num,disc_num,size,mtime,inode,))
 				row_id = cur.lastrowid
 			except sql.IntegrityError:
-				cur.execute("SELECT id FROM song WHERE name=? AND album_id=? LIMIT 1", (song,album_id,))
-				row_id = cur.fetchone()[0]
+				cur.execute("SELECT id, path, deleted FROM song WHERE name=? AND album_id=? LIMIT 1", (song,album_id,))
+				row_id, known_path, deleted = cur.fetchone()
+				if not deleted and known_path != path and isfile(known_path):
+					# Another copy of a song which is still where it
+					# was; keep the song where it is rather than
+					# moving it back and forth on every scan.
+					return row_id
+				# Known song: refresh where its file is and what its
+				# tags say, and bring it back if it had been deleted.
+				cur.execute("UPDATE song SET path=?, base_path=?, genre_id=?, track_num=?, disc_num=?, size=?, mtime=?, inode=?, deleted=0 WHERE id=?", (path,base_path,genre_id,track_num,disc_num,size,mtime,inode,row_id,))
+			# A file retagged with a new title or album replaces the
+			# song it used to be
+			cur.execute("UPDATE song SET deleted=1 WHERE path=? AND id<>? AND deleted=0", (path,row_id,))
 			return row_id
 		return None
-	def _make_sql_from_query(self,qdict):
-		sql = 'SELECT'
-		for pair in self.query_fields:
-			sql = '%s %s AS %s,' % (sql, pair[0], pair[1])
-		sql = '%s FROM song, album, artist, genre, publisher' % sql.rstrip(',')
-		w = 'WHERE'
+	def _get_query_column(self,key):
+		key = key.strip('\'').strip('"')
+		for column, name in self.query_fields:
+			if key == name or key == column:
+				return column
+		raise ValueError('Unknown query field "%s"' % key)
+	def _make_sql_from_query(self,qdict,order_by=None,limit=None,offset=None,after=None):
+		'''Builds the song query for qdict.  Returns the SQL,
+		which uses explicit joins, and the values to bind to it.
+		'''
+		columns = ', '.join(['%s AS %s' % pair for pair in self.query_fields])
+		joins = ' '.join(['JOIN %s ON %s' % pair for pair in self.query_joins])
+		where = ['song.deleted=0']
+		params = []
 		if qdict:
 			for k,v in qdict.items():
-				sql = "%s %s %s='%s'" % (sql, w, k.strip('\'').strip('"'), v.strip('\'').strip('"'))
-				w = 'AND'
-		for jl, jr in {
-			'song.album_id':'album.id',
-			'song.artist_id':'artist.id',
-			'song.genre_id':'genre.id',
-			'album.artist_id':'artist.id',
-			'album.publisher_id':'publisher.id'
-			}.items():
-			sql = '%s %s %s=%s' % (sql, w, jl, jr)
-			w = 'AND'
-		return sql
+				where.append('%s=?' % self._get_query_column(k))
+				params.append(v.strip('\'').strip('"'))
+		order = []
+		if order_by or limit is not None or offset or after:
+			# Paging needs a stable order
+			row_columns = dict(zip(AFLibraryEntry.row_fields,
+							[column for column, name in self.query_fields]))
+			order = [(row_columns[field], descending)
+						for field, descending in self._get_order(order_by)]
+		if after:
+			condition, after_params = self._make_keyset_condition(order, after)
+			where.append(condition)
+			params.extend(after_params)
+		sqlstmt = 'SELECT %s FROM song %s WHERE %s' % (columns, joins, ' AND '.join(where))
+		if order:
+			sqlstmt = '%s ORDER BY %s' % (sqlstmt, ', '.join(
+						['%s%s' % (column, ' DESC' if descending else '')
+						for column, descending in order]))
+		if limit is not None or offset:
+			sqlstmt = '%s LIMIT ? OFFSET ?' % sqlstmt
+			params.extend([limit if limit is not None else -1, offset or 0])
+		return sqlstmt, params
+	def _make_keyset_condition(self,order,after):
+		'''Builds the condition for the rows which sort after the
+		key after, for the (column, descending) pairs in order.'''
+		if len(after) != len(order):
+			raise ValueError('Page key has %d values for %d order columns' % (len(after), len(order)))
+		if sql.sqlite_version_info >= (3, 15, 0) and None not in after and \
+			not [column for column, descending in order if descending]:
+			# A row value comparison lets SQLite seek straight to
+			# the page through an index on the order columns
+			columns = ', '.join([column for column, descending in order])
+			marks = ', '.join(['?'] * len(order))
+			return '(%s) > (%s)' % (columns, marks), list(after)
+		# Otherwise spell it out; NULLs sort first, so nothing but
+		# a NULL sorts before one going up, or after one going down
+		clauses = []
+		params = []
+		for i, (column, descending) in enumerate(order):
+			terms = ['%s IS ?' % prev for prev, prev_descending in order[:i]]
+			term_params = list(after[:i])
+			value = after[i]
+			if value is None:
+				if descending:
+					continue
+				terms.append('%s IS NOT NULL' % column)
+			elif descending:
+				terms.append('(%s<? OR %s IS NULL)' % (column, column))
+				term_params.append(value)
+			else:
+				terms.append('%s>?' % column)
+				term_params.append(value)
+			clauses.append('(%s)' % ' AND '.join(terms))
+			params.extend(term_params)
+		if not clauses:
+			return '0', []
+		return '(%s)' % ' OR '.join(clauses), params
+	def explain_query(self,qdict,order_by=None,limit=None,offset=None,after=None):
+		'''Returns SQLite's query plan for qdict, one line per step.'''
+		sqlstmt, params = self._make_sql_from_query(qdict,order_by,limit,offset,after)
+		dbconn = self._get_connection()
+		cur = dbconn.cursor()
+		cur.execute('EXPLAIN QUERY PLAN %s' % sqlstmt, params)
+		plan = [row[-1] for row in cur.fetchall()]
+		return plan
 
 	def create_db(self):
-		self.dbname = expanduser('~/.audiofile/lib.db')
 		if not isdir(dirname(self.dbname)):
 			makedirs(dirname(self.dbname))
 		if not self._have_schema():
 			self._clear_db()
-		dbconn = self._get_connection()
+		with self.write_lock:
+			self._create_schema(self._get_writer_connection())
+	def _create_schema(self,dbconn):
 		cur = dbconn.cursor()
 		cur.executescript("""
 			CREATE TABLE IF NOT EXISTS publisher(id INTEGER PRIMARY KEY, name VARCHAR UNIQUE);
 			CREATE TABLE IF NOT EXISTS genre(id INTEGER PRIMARY KEY, name VARCHAR UNIQUE);
 			CREATE TABLE IF NOT EXISTS artist(id INTEGER PRIMARY KEY, name VARCHAR UNIQUE);
 			CREATE TABLE IF NOT EXISTS album(id INTEGER PRIMARY KEY, name VARCHAR, artist_id INTEGER, track_count INTEGER, disc_count INTEGER DEFAULT 1, publisher_id INTEGER, year VARCHAR DEFAULT NULL, FOREIGN KEY(artist_id) REFERENCES artist(id), FOREIGN KEY(publisher_id) REFERENCES publisher(id));
-			CREATE TABLE IF NOT EXISTS song(id INTEGER PRIMARY KEY, name VARCHAR, path VARCHAR, base_path VARCHAR, album_id INTEGER, artist_id INTEGER, genre_id INTEGER, track_num INTEGER, disc_num INTEGER, FOREIGN KEY(album_id) REFERENCES album(id), FOREIGN KEY(artist_id) REFERENCES artist(id), FOREIGN KEY(genre_id) REFERENCES genre(id));
+			CREATE TABLE IF NOT EXISTS song(id INTEGER PRIMARY KEY, name VARCHAR, path VARCHAR, base_path VARCHAR, album_id INTEGER, artist_id INTEGER, genre_id INTEGER, track_num INTEGER, disc_num INTEGER, size INTEGER, mtime REAL, inode INTEGER, deleted INTEGER DEFAULT 0, FOREIGN KEY(album_id) REFERENCES album(id), FOREIGN KEY(artist_id) REFERENCES artist(id), FOREIGN KEY(genre_id) REFERENCES genre(id));
 			CREATE UNIQUE INDEX IF NOT EXISTS unique_album ON album(name,artist_id);
 			CREATE UNIQUE INDEX IF NOT EXISTS unique_song ON song(name,album_id);
 		""")
+		self._upgrade_song_table(dbconn)
+		# Lookup indexes for queries; the name columns of artist,
+		# genre and publisher are already covered by their UNIQUE
+		# constraints and album.name by unique_album.  Artist and
+		# album pages are also returned in disc/track/id order
+		# straight from their indexes (an index ends in the rowid,
+		# which is song.id), and these replace the plain ones.
+		cur.executescript("""
+			CREATE INDEX IF NOT EXISTS song_artist_page ON song(artist_id,deleted,disc_num,track_num);
+			CREATE INDEX IF NOT EXISTS song_album_page ON song(album_id,deleted,disc_num,track_num);
+			DROP INDEX IF EXISTS song_artist;
+			DROP INDEX IF EXISTS song_album;
+			DROP INDEX IF EXISTS song_artist_order;
+			DROP INDEX IF EXISTS song_album_order;
+			CREATE INDEX IF NOT EXISTS song_genre ON song(genre_id,deleted);
+			CREATE INDEX IF NOT EXISTS song_path ON song(path);
+			CREATE INDEX IF NOT EXISTS album_artist ON album(artist_id);
+			CREATE INDEX IF NOT EXISTS album_year ON album(year);
+			CREATE INDEX IF NOT EXISTS album_publisher ON album(publisher_id);
+		""")
+		self._create_search_index(dbconn)
 		dbconn.commit()
-		dbconn.close()
-	def save_mp3(self,entry):
-		dbconn = self._get_connection()
+	def _create_search_index(self,dbconn):
+		# Full text index over the names, keyed on song.id and kept
+		# in step by _save_entry().  Prefix indexes make "beatl*"
+		# style searches cheap.  SQLite builds without FTS5 fall
+		# back to LIKE scans in search().
+		cur = dbconn.cursor()
+		cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='song_search'")
+		if cur.fetchone()[0]:
+			self.have_search_index = True
+			return
+		try:
+			cur.execute("CREATE VIRTUAL TABLE song_search USING fts5(title, artist, album, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+		except sql.OperationalError:
+			self.have_search_index = False
+			return
+		# Index whatever the library already holds
+		cur.execute('INSERT INTO song_search(rowid, title, artist, album) SELECT song.id, song.name, artist.name, album.name FROM song JOIN album ON song.album_id=album.id JOIN artist ON song.artist_id=artist.id')
+		self.have_search_index = True
+	def _has_search_index(self,dbconn):
+		if self.have_search_index is None:
+			cur = dbconn.cursor()
+			cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='song_search'")
+			self.have_search_index = cur.fetchall()[0][0] > 0
+			cur.close()
+		return self.have_search_index
+	def _upgrade_song_table(self,dbconn):
+		# Libraries created before file fingerprints were tracked
+		# are missing some of the song columns.
+		cur = dbconn.cursor()
+		cur.execute('PRAGMA table_info(song)')
+		columns = [row[1] for row in cur.fetchall()]
+		for name, decl in self.song_file_columns:
+			if name not in columns:
+				cur.execute('ALTER TABLE song ADD COLUMN %s %s' % (name, decl))
+	def _save_entry(self,entry,dbconn):
 		publisher_id = self._get_or_create_id('publisher',entry.publisher,dbconn)
 		genre_id = self._get_or_create_id('genre',entry.genre,dbconn)
 		artist_id = self._get_or_create_id('artist',entry.artist,dbconn)
@@ -171,104 +599,1263 @@ class AFSqliteDataStore(AFDataStore):
 			song_id = self._get_or_create_song_id(entry.title,
 							entry.path,entry.base_path,album_id,
 							artist_id,genre_id,entry.track_num,
-							entry.disc_num,dbconn)
-		dbconn.close()
-	def get_query_result_set(self,qdict):
-		sqlstmt = self._make_sql_from_query(qdict)
+							entry.disc_num,entry.size,entry.mtime,
+							entry.inode,dbconn)
+			if song_id and self._has_search_index(dbconn):
+				dbconn.execute('INSERT OR REPLACE INTO song_search(rowid, title, artist, album) VALUES (?,?,?,?)',
+								(song_id,entry.title,entry.artist,entry.album))
+	def save_mp3(self,entry):
+		return self.save_mp3_batch([entry])
+	def save_mp3_batch(self,entries,errors=None):
+		'''Saves the entries in a single transaction on the
+		writer connection, so the batch costs one commit.  If any
+		entry fails the batch is rolled back and saved again one
+		entry per transaction, so only the entries which fail are
+		lost.'''
+		with self.write_lock:
+			dbconn = self._get_writer_connection()
+			try:
+				for entry in entries:
+					self._save_entry(entry,dbconn)
+				dbconn.commit()
+				self.generation += 1
+				return len(entries)
+			except Exception:
+				self._rollback(dbconn)
+			saved = 0
+			failed = []
+			for entry in entries:
+				try:
+					self._save_entry(entry,dbconn)
+					dbconn.commit()
+					saved += 1
+				except Exception as e:
+					self._rollback(dbconn)
+					failed.append((entry, e))
+			self.generation += 1
+		return self._report_failures(saved,failed,errors)
+	def _rollback(self,dbconn):
+		dbconn.rollback()
+		# Ids handed out inside the failed transaction are gone
+		self.id_cache.clear()
+	def get_file_fingerprints(self,base_path):
 		dbconn = self._get_connection()
 		cur = dbconn.cursor()
-		cur.execute(sqlstmt)
-		rows = cur.fetchall()
-		dbconn.close()
+		cur.execute('SELECT path, size, mtime, inode FROM song WHERE base_path=? AND deleted=0', (base_path,))
+		fingerprints = {}
+		for row in cur:
+			fingerprints[row[0]] = (row[1], row[2], row[3])
+		return fingerprints
+	def delete_paths(self,paths):
+		with self.write_lock:
+			dbconn = self._get_writer_connection()
+			cur = dbconn.cursor()
+			cur.executemany('UPDATE song SET deleted=1 WHERE path=?', [(path,) for path in paths])
+			dbconn.commit()
+			self.generation += 1
+	def update_paths(self,moves):
+		'''Applies all of the renames in one transaction.'''
+		moves = list(moves)
+		with self.write_lock:
+			dbconn = self._get_writer_connection()
+			cur = dbconn.cursor()
+			try:
+				# Drop any tombstone left at a new path so the path
+				# still identifies a single song
+				cur.executemany('DELETE FROM song WHERE path=? AND deleted=1',
+								[(new,) for old, new in moves])
+				cur.executemany('UPDATE song SET path=? WHERE path=?',
+								[(new, old) for old, new in moves])
+				dbconn.commit()
+				self.generation += 1
+			except:
+				dbconn.rollback()
+				raise
+	def _get_query_rows(self,qdict,batch_size,order_by=None,limit=None,offset=None,after=None):
+		sqlstmt, params = self._make_sql_from_query(qdict,order_by,limit,offset,after)
+		cur = self._get_connection().cursor()
+		try:
+			cur.execute(sqlstmt, params)
+			while True:
+				rows = cur.fetchmany(batch_size)
+				if not rows:
+					break
+				for row in rows:
+					yield row
+		finally:
+			cur.close()
+	def get_query_result_set(self,qdict,batch_size=1000,order_by=None,limit=None,offset=None,after=None):
+		fields = AFLibraryEntry.row_fields
+		for row in self._get_query_rows(qdict,batch_size,order_by,limit,offset,after):
+			yield dict(zip(fields, row))
+	def get_entries(self,qdict,batch_size=1000,order_by=None,limit=None,offset=None,after=None):
+		for row in self._get_query_rows(qdict,batch_size,order_by,limit,offset,after):
+			yield AFLibraryEntry.from_row(row)
+	def _make_sql_from_search(self,words,limit):
+		'''Builds the search for words, each matched as a prefix
+		through the full text index, or as a substring of the
+		title, artist or album name where there is no index.'''
+		columns = ', '.join(['%s AS %s' % pair for pair in self.query_fields])
+		joins = ' '.join(['JOIN %s ON %s' % pair for pair in self.query_joins])
+		if self._has_search_index(self._get_connection()):
+			match = ' '.join(['"%s"*' % w.replace('"', '""') for w in words])
+			sqlstmt = 'SELECT %s FROM song_search JOIN song ON song.id=song_search.rowid %s WHERE song_search MATCH ? AND song.deleted=0 ORDER BY song_search.rank LIMIT ?' % (columns, joins)
+			return sqlstmt, [match, limit]
+		where = ['song.deleted=0']
+		params = []
+		for w in words:
+			where.append('(song.name LIKE ? OR artist.name LIKE ? OR album.name LIKE ?)')
+			params.extend(['%%%s%%' % w] * 3)
+		sqlstmt = 'SELECT %s FROM song %s WHERE %s LIMIT ?' % (columns, joins, ' AND '.join(where))
+		return sqlstmt, params + [limit]
+	def search(self,text,limit=50):
+		if isinstance(text, str):
+			text = text.decode('utf-8')
+		words = re.findall(r'\w+', text, re.UNICODE)
+		if not words:
+			return
+		sqlstmt, params = self._make_sql_from_search(words,limit)
+		cur = self._get_connection().cursor()
+		try:
+			cur.execute(sqlstmt, params)
+			fields = AFLibraryEntry.row_fields
+			for row in cur.fetchall():
+				yield dict(zip(fields, row))
+		finally:
+			cur.close()
+	def _get_aggregate_filter(self,key):
+		# Filters on names become lookups of the matching ids, so
+		# the song table can be grouped without joining every row
+		column = self._get_query_column(key)
+		table, name = column.split('.')
+		if table == 'song':
+			return '%s=?' % column
+		if table in ('artist', 'genre'):
+			return 'song.%s_id=(SELECT id FROM %s WHERE name=?)' % (table, table)
+		if table == 'publisher':
+			return 'song.album_id IN (SELECT album.id FROM album JOIN publisher ON album.publisher_id=publisher.id WHERE publisher.name=?)'
+		return 'song.album_id IN (SELECT id FROM album WHERE %s=?)' % name
+	def _make_sql_from_aggregate(self,fields,qdict,distinct):
+		'''Builds the aggregate query: the songs are grouped and
+		counted on their own (mostly id) columns first, and the
+		names for each group looked up afterwards.'''
+		keys = []
+		outer = []
+		joins = []
+		for i, field in enumerate(fields):
+			column, table = self.aggregate_columns[field]
+			keys.append('%s AS k%d' % (column, i))
+			if table:
+				joins.append('LEFT JOIN %s AS n%d ON n%d.id=g.k%d' % (table, i, i, i))
+				outer.append('n%d.name' % i)
+			else:
+				outer.append('g.k%d' % i)
+		if distinct is None:
+			count = 'COUNT(*)'
+		else:
+			count = 'COUNT(DISTINCT %s)' % self.aggregate_columns[distinct][0]
+		where = ['song.deleted=0']
+		params = []
+		if qdict:
+			for k,v in qdict.items():
+				where.append(self._get_aggregate_filter(k))
+				params.append(v.strip('\'').strip('"'))
+		inner_from = 'song'
+		if [f for f in fields + [distinct] if f and self.aggregate_columns[f][0].startswith('album.')]:
+			inner_from = 'song JOIN album ON song.album_id=album.id'
+		group = ', '.join(['k%d' % i for i in range(len(fields))])
+		inner = 'SELECT %s, %s AS count FROM %s WHERE %s GROUP BY %s' % \
+			(', '.join(keys), count, inner_from, ' AND '.join(where), group)
+		sqlstmt = 'SELECT %s, g.count FROM (%s) AS g %s ORDER BY g.count DESC, %s' % \
+			(', '.join(outer), inner, ' '.join(joins), ', '.join(outer))
+		return sqlstmt, params
+	def aggregate(self,group_by,qdict=None,distinct=None):
+		fields = self._get_aggregate_fields(group_by,distinct)
+		sqlstmt, params = self._make_sql_from_aggregate(fields,qdict,distinct)
+		cur = self._get_connection().cursor()
+		try:
+			cur.execute(sqlstmt, params)
+			keys = fields + ['count']
+			return [dict(zip(keys, row)) for row in cur.fetchall()]
+		finally:
+			cur.close()
+
+class AFColumnDictionary:
+	'''Dictionary encoding for a column: each distinct value is
+	stored once, and the column holds its integer code instead.'''
+	def __init__(self):
+		self.values = []
+		self.codes = {}
+	def encode(self,value):
+		code = self.codes.get(value)
+		if code is None:
+			code = self.codes[value] = len(self.values)
+			self.values.append(value)
+		return code
+	def __len__(self):
+		return len(self.values)
+
+class AFMemoryDataStore(AFDataStore):
+	'''Implementation of AFDataStore which keeps the audiofile
+	library in memory, for tests, benchmarks and short-lived
+	query servers; nothing outlives the process.
+	Songs are stored column-wise, one column per field indexed
+	by row number, with artist, genre and publisher names and
+	albums dictionary-encoded.  The song columns queries look at
+	have hash indexes of their live rows, and the album columns
+	of their albums, so queries intersect index entries rather
+	than scanning.
+	'''
+	# Columns holding a code rather than a value, and the
+	# dictionary the code is looked up in
+	song_codes = {'artist': 'artists', 'genre': 'genres'}
+	# Fields kept per album rather than per song
+	album_fields = {
+		'album': 'name',
+		'total_tracks': 'total_tracks',
+		'total_discs': 'total_discs',
+		'publisher': 'publisher',
+		'year': 'year'
+	}
+	int_fields = ('track_num', 'disc_num', 'total_tracks', 'total_discs')
+	indexed_song_columns = ('title', 'path', 'base_path', 'track_num',
+		'disc_num', 'album', 'artist', 'genre')
+	def __init__(self):
+		self.lock = Lock()
+		self._clear_db()
+	def _clear_db(self):
+		self.artists = AFColumnDictionary()
+		self.genres = AFColumnDictionary()
+		self.publishers = AFColumnDictionary()
+		self.songs = {
+			'title': [], 'path': [], 'base_path': [],
+			'track_num': [], 'disc_num': [],
+			'album': array('l'), 'artist': array('l'), 'genre': array('l'),
+			'size': [], 'mtime': [], 'inode': [],
+			'deleted': array('b')
+		}
+		self.albums = {
+			'name': [], 'artist': array('l'),
+			'total_tracks': [], 'total_discs': [],
+			'publisher': array('l'), 'year': []
+		}
+		# (name, artist code) -> album code, (title, album code) -> row
+		self.album_keys = {}
+		self.song_keys = {}
+		# path -> rows, deleted or not, as update_paths() needs
+		self.path_rows = {}
+		self.song_indexes = dict([(c, {}) for c in self.indexed_song_columns])
+		self.album_indexes = dict([(c, {}) for c in self.album_fields.values()])
+		# Words of the titles, artists and albums, for search()
+		self.words = {}
+		self.vocabulary = None
+		# Rows of the whole library in each recently used order
+		self.orders = OrderedDict()
+		self.n_live = 0
+		self.generation += 1
+	def __str__(self):
+		return '%d songs, %d albums, %d artists, %d genres in memory' % \
+			(self.n_live, len(self.albums['name']), len(self.artists), len(self.genres))
+	def _index_add(self,index,value,row):
+		# Most values of the path and title columns belong to a
+		# single row, so that is stored bare and only replaced by
+		# a set when a second row turns up.
+		rows = index.get(value)
+		if rows is None:
+			index[value] = row
+		elif isinstance(rows, set):
+			rows.add(row)
+		else:
+			index[value] = set([rows, row])
+	def _index_remove(self,index,value,row):
+		rows = index.get(value)
+		if isinstance(rows, set):
+			rows.discard(row)
+			if not rows:
+				del index[value]
+		elif rows == row:
+			del index[value]
+	def _index_get(self,index,value):
+		rows = index.get(value)
+		if rows is None:
+			return set()
+		if isinstance(rows, set):
+			return rows
+		return set([rows])
+	def _add_live(self,row):
+		for column, index in self.song_indexes.iteritems():
+			self._index_add(index, self.songs[column][row], row)
+		self.songs['deleted'][row] = 0
+		self.n_live += 1
+	def _remove_live(self,row):
+		for column, index in self.song_indexes.iteritems():
+			self._index_remove(index, self.songs[column][row], row)
+		self.songs['deleted'][row] = 1
+		self.n_live -= 1
+	def _text(self,value):
+		if isinstance(value, str):
+			return value.decode('utf-8', 'replace')
+		return value
+	def _words(self,text):
+		# Folded as the SQLite full text index folds them: lower
+		# case, with accents removed
+		text = unicodedata.normalize('NFKD', text.lower())
+		text = u''.join([c for c in text if not unicodedata.combining(c)])
+		return re.findall(r'\w+', text, re.UNICODE)
+	def _get_album_code(self,entry,artist):
+		name = self._text(entry.album)
+		key = (name, artist)
+		code = self.album_keys.get(key)
+		if code is None:
+			# As with the other datastores an album keeps the
+			# details of the first of its songs to be saved
+			code = self.album_keys[key] = len(self.albums['name'])
+			values = {
+				'name': name,
+				'artist': artist,
+				'total_tracks': entry.total_tracks,
+				'total_discs': entry.total_discs,
+				'publisher': self.publishers.encode(self._text(entry.publisher)),
+				'year': self._text(entry.year)
+			}
+			for column, value in values.iteritems():
+				self.albums[column].append(value)
+				if column in self.album_indexes:
+					self.album_indexes[column].setdefault(value, set()).add(code)
+		return code
+	def _save_entry(self,entry):
+		# As in SQLite, an album is made as soon as its artist and
+		# publisher are known, but its songs also need a genre
+		if not (entry.album and entry.artist and entry.publisher):
+			return
+		artist = self.artists.encode(self._text(entry.artist))
+		album = self._get_album_code(entry, artist)
+		if not (entry.title and entry.genre):
+			return
+		title = self._text(entry.title)
+		path = self._text(entry.path)
+		row = self.song_keys.get((title, album))
+		songs = self.songs
+		if row is not None:
+			known_path = songs['path'][row]
+			if not songs['deleted'][row] and known_path != path and isfile(known_path):
+				# Another copy of a song which is still where it was
+				return
+			# Known song: refresh where its file is and what its tags
+			# say, and bring it back if it had been marked as deleted
+			if not songs['deleted'][row]:
+				self._remove_live(row)
+			self._index_remove(self.path_rows, known_path, row)
+			songs['path'][row] = path
+			songs['base_path'][row] = self._text(entry.base_path)
+			songs['genre'][row] = self.genres.encode(self._text(entry.genre))
+			songs['track_num'][row] = entry.track_num
+			songs['disc_num'][row] = entry.disc_num
+			songs['size'][row] = entry.size
+			songs['mtime'][row] = entry.mtime
+			songs['inode'][row] = entry.inode
+			self._retire_path(path)
+			self._index_add(self.path_rows, path, row)
+			self._add_live(row)
+			return
+		self._retire_path(path)
+		row = self.song_keys[(title, album)] = len(songs['title'])
+		values = {
+			'title': title,
+			'path': path,
+			'base_path': self._text(entry.base_path),
+			'track_num': entry.track_num,
+			'disc_num': entry.disc_num,
+			'album': album,
+			'artist': artist,
+			'genre': self.genres.encode(self._text(entry.genre)),
+			'size': entry.size,
+			'mtime': entry.mtime,
+			'inode': entry.inode,
+			'deleted': 1
+		}
+		for column, value in values.iteritems():
+			songs[column].append(value)
+		self._index_add(self.path_rows, path, row)
+		self._add_live(row)
+		for text in (title, self.artists.values[artist], self.albums['name'][album]):
+			for word in self._words(text):
+				if word not in self.words:
+					self.vocabulary = None
+				self._index_add(self.words, word, row)
+	def _retire_path(self,path):
+		# A file retagged with a new title or album replaces the
+		# song it used to be
+		for row in list(self._index_get(self.path_rows, path)):
+			if not self.songs['deleted'][row]:
+				self._remove_live(row)
+	def create_db(self):
+		pass
+	def save_mp3(self,entry):
+		return self.save_mp3_batch([entry])
+	def save_mp3_batch(self,entries,errors=None):
+		saved = 0
+		failed = []
+		with self.lock:
+			for entry in entries:
+				try:
+					self._save_entry(entry)
+					saved += 1
+				except Exception as e:
+					failed.append((entry, e))
+			self.orders.clear()
+			self.generation += 1
+		return self._report_failures(saved,failed,errors)
+	def get_file_fingerprints(self,base_path):
+		with self.lock:
+			songs = self.songs
+			fingerprints = {}
+			for row in self._index_get(self.song_indexes['base_path'], self._text(base_path)):
+				fingerprints[songs['path'][row]] = (songs['size'][row], songs['mtime'][row], songs['inode'][row])
+			return fingerprints
+	def delete_paths(self,paths):
+		with self.lock:
+			for path in paths:
+				for row in list(self._index_get(self.path_rows, self._text(path))):
+					if not self.songs['deleted'][row]:
+						self._remove_live(row)
+			self.orders.clear()
+			self.generation += 1
+	def update_paths(self,moves):
+		moves = [(self._text(old), self._text(new)) for old, new in moves]
+		songs = self.songs
+		with self.lock:
+			# Forget any deleted song at a new path so the path
+			# still identifies a single song
+			for old, new in moves:
+				for row in list(self._index_get(self.path_rows, new)):
+					if songs['deleted'][row]:
+						self._index_remove(self.path_rows, new, row)
+						key = (songs['title'][row], songs['album'][row])
+						if self.song_keys.get(key) == row:
+							del self.song_keys[key]
+			for old, new in moves:
+				for row in list(self._index_get(self.path_rows, old)):
+					live = not songs['deleted'][row]
+					if live:
+						self._remove_live(row)
+					self._index_remove(self.path_rows, old, row)
+					songs['path'][row] = new
+					self._index_add(self.path_rows, new, row)
+					if live:
+						self._add_live(row)
+			self.orders.clear()
+			self.generation += 1
+	def _get_field(self,key):
+		# query_fields are in AFLibraryEntry.row_fields order
+		key = key.strip('\'').strip('"')
+		for (column, name), field in zip(self.query_fields, AFLibraryEntry.row_fields):
+			if key == name or key == column:
+				return field
+		raise ValueError('Unknown query field "%s"' % key)
+	def _get_value_reader(self,field):
+		'''Returns a function reading the value of field for a row.'''
+		songs = self.songs
+		if field == 'id':
+			# A song's id is its row
+			return lambda row: row
+		if field in self.album_fields:
+			column = self.albums[self.album_fields[field]]
+			album = songs['album']
+			if field == 'publisher':
+				names = self.publishers.values
+				return lambda row: names[column[album[row]]]
+			return lambda row: column[album[row]]
+		column = songs[field]
+		if field in self.song_codes:
+			names = getattr(self, self.song_codes[field]).values
+			return lambda row: names[column[row]]
+		return column.__getitem__
+	def _get_condition_rows(self,field,value):
+		'''Returns the live rows whose field is value.'''
+		value = self._text(value.strip('\'').strip('"'))
+		if field == 'id':
+			try:
+				row = int(value)
+			except ValueError:
+				return set()
+			if 0 <= row < len(self.songs['deleted']) and not self.songs['deleted'][row]:
+				return set([row])
+			return set()
+		if field in self.int_fields:
+			try:
+				value = int(value)
+			except ValueError:
+				return set()
+		if field == 'album':
+			albums = self.album_indexes['name'].get(value, ())
+		elif field in self.album_fields:
+			if field == 'publisher':
+				value = self.publishers.codes.get(value)
+			albums = self.album_indexes[self.album_fields[field]].get(value, ())
+		else:
+			if field in self.song_codes:
+				value = getattr(self, self.song_codes[field]).codes.get(value)
+			return self._index_get(self.song_indexes[field], value)
+		index = self.song_indexes['album']
+		rows = set()
+		for album in albums:
+			rows.update(self._index_get(index, album))
+		return rows
+	def _get_conditions(self,qdict):
+		'''Returns (description, rows) for each condition in qdict,
+		fewest rows first.'''
+		conditions = []
+		for k,v in (qdict or {}).items():
+			field = self._get_field(k)
+			conditions.append(('%s=%s' % (field, v), self._get_condition_rows(field, v)))
+		conditions.sort(key=lambda c: len(c[1]))
+		return conditions
+	def _match(self,conditions):
+		'''Returns the live rows meeting all of the conditions, or
+		None for the whole library.'''
+		if not conditions:
+			return None
+		rows = set(conditions[0][1])
+		for description, condition_rows in conditions[1:]:
+			rows.intersection_update(condition_rows)
+		return rows
+	def _all_rows(self):
+		deleted = self.songs['deleted']
+		return [row for row in xrange(len(deleted)) if not deleted[row]]
+	def _sort(self,rows,order):
+		# One stable sort per key, least significant first, so
+		# each key can have its own direction
+		for field, descending in reversed(order):
+			rows.sort(key=self._get_value_reader(field), reverse=descending)
+		return rows
+	def _follows(self,row,readers,after):
+		# NULLs (None) sort first going up, as in SQLite
+		for (read, descending), value in zip(readers, after):
+			v = read(row)
+			if v != value:
+				return v < value if descending else v > value
+		return False
+	def _get_ordered_rows(self,order):
+		'''Returns every live row in order, sorting only when the
+		library has changed since that order was last asked for.'''
+		key = tuple(order)
+		rows = self.orders.pop(key, None)
+		if rows is None:
+			rows = array('l', self._sort(self._all_rows(), order))
+		self.orders[key] = rows
+		while len(self.orders) > 4:
+			self.orders.popitem(last=False)
+		return rows
+	def _get_result_rows(self,qdict,order_by=None,limit=None,offset=None,after=None,plan=None):
+		conditions = self._get_conditions(qdict)
+		rows = self._match(conditions)
+		if plan is not None:
+			for description, condition_rows in conditions:
+				plan.append('LOOKUP %s (%d songs)' % (description, len(condition_rows)))
+			if rows is None:
+				plan.append('SCAN %d songs' % self.n_live)
+		if not (order_by or limit is not None or offset or after):
+			if rows is None:
+				return self._all_rows()
+			return sorted(rows)
+		# Paging needs a stable order
+		order = self._get_order(order_by)
+		readers = [(self._get_value_reader(field), descending) for field, descending in order]
+		if after and len(after) != len(order):
+			raise ValueError('Page key has %d values for %d order columns' % (len(after), len(order)))
+		start = offset or 0
+		end = start + limit if limit is not None else None
+		order_text = ', '.join(['%s%s' % (field, ' DESC' if descending else '')
+							for field, descending in order])
+		if rows is None:
+			# The whole library: keep it sorted, and binary search
+			# for the page
+			ordered = self._get_ordered_rows(order)
+			if after:
+				lo, hi = 0, len(ordered)
+				while lo < hi:
+					mid = (lo + hi) // 2
+					if self._follows(ordered[mid], readers, after):
+						hi = mid
+					else:
+						lo = mid + 1
+				start += lo
+				if end is not None:
+					end += lo
+			if plan is not None:
+				plan.append('ORDER BY %s (sorted library)' % order_text)
+			return ordered[start:end]
+		if after:
+			rows = [row for row in rows if self._follows(row, readers, after)]
+		if plan is not None:
+			plan.append('ORDER BY %s (sort %d songs)' % (order_text, len(rows)))
+		return self._sort(list(rows), order)[start:end]
+	def _get_rows(self,rows):
+		'''Returns the query result tuple for each of rows, in
+		AFLibraryEntry.row_fields order.'''
+		songs = self.songs
+		albums = self.albums
+		title, path, base_path = songs['title'], songs['path'], songs['base_path']
+		track_num, disc_num = songs['track_num'], songs['disc_num']
+		album, artist, genre = songs['album'], songs['artist'], songs['genre']
+		album_name, total_tracks, total_discs = albums['name'], albums['total_tracks'], albums['total_discs']
+		year, publisher = albums['year'], albums['publisher']
+		artists, genres, publishers = self.artists.values, self.genres.values, self.publishers.values
 		results = []
 		for row in rows:
-			result = {}
-			result['title'] = row[0]
-			result['path'] = row[1]
-			result['base_path'] = row[2]
-			result['track_num'] = row[3]
-			result['disc_num'] = row[4]
-			result['album'] = row[5]
-			result['total_tracks'] = row[6]
-			result['total_discs'] = row[7]
-			result['year'] = row[8]
-			result['artist'] = row[9]
-			result['publisher'] = row[10]
-			result['genre'] = row[11]
-			results.append(result)
+			a = album[row]
+			results.append((title[row], path[row], base_path[row],
+				track_num[row], disc_num[row], album_name[a], total_tracks[a],
+				total_discs[a], year[a], artists[artist[row]],
+				publishers[publisher[a]], genres[genre[row]], row))
+		return results
+	def explain_query(self,qdict,order_by=None,limit=None,offset=None,after=None):
+		'''Returns how the query for qdict is run, one line per step.'''
+		plan = []
+		with self.lock:
+			self._get_result_rows(qdict,order_by,limit,offset,after,plan)
+		return plan
+	def _get_query_rows(self,qdict,batch_size,order_by=None,limit=None,offset=None,after=None):
+		# The results are read under the lock in batch_size pieces
+		with self.lock:
+			rows = self._get_result_rows(qdict,order_by,limit,offset,after)
+		for i in xrange(0, len(rows), batch_size):
+			with self.lock:
+				results = self._get_rows(rows[i:i + batch_size])
+			for result in results:
+				yield result
+	def get_query_result_set(self,qdict,batch_size=1000,order_by=None,limit=None,offset=None,after=None):
+		fields = AFLibraryEntry.row_fields
+		for row in self._get_query_rows(qdict,batch_size,order_by,limit,offset,after):
+			yield dict(zip(fields, row))
+	def get_entries(self,qdict,batch_size=1000,order_by=None,limit=None,offset=None,after=None):
+		for row in self._get_query_rows(qdict,batch_size,order_by,limit,offset,after):
+			yield AFLibraryEntry.from_row(row)
+	def _get_prefix_rows(self,prefix):
+		if self.vocabulary is None:
+			self.vocabulary = sorted(self.words)
+		rows = set()
+		i = bisect_left(self.vocabulary, prefix)
+		while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+			rows.update(self._index_get(self.words, self.vocabulary[i]))
+			i += 1
+		return rows
+	def search(self,text,limit=50):
+		'''Matches each word as a prefix of a word of the title,
+		artist or album, like the SQLite full text index; songs
+		matching more of the words whole come first.'''
+		if isinstance(text, str):
+			text = text.decode('utf-8')
+		words = self._words(text)
+		if not words:
+			return
+		with self.lock:
+			deleted = self.songs['deleted']
+			rows = None
+			for word in words:
+				word_rows = self._get_prefix_rows(word)
+				rows = word_rows if rows is None else rows & word_rows
+			rows = [row for row in rows if not deleted[row]]
+			exact = [self._index_get(self.words, word) for word in words]
+			rows.sort(key=lambda row: (-sum([1 for e in exact if row in e]), row))
+			results = self._get_rows(rows[:limit])
+		fields = AFLibraryEntry.row_fields
+		for result in results:
+			yield dict(zip(fields, result))
+	def _get_group_reader(self,field):
+		# Groups are told apart by code where the field has one,
+		# which also keeps albums of the same name apart
+		songs = self.songs
+		if field == 'album':
+			return songs['album'].__getitem__
+		if field in self.album_fields:
+			column = self.albums[self.album_fields[field]]
+			album = songs['album']
+			return lambda row: column[album[row]]
+		return songs[field].__getitem__
+	def _get_album_group_reader(self,field):
+		if field == 'album':
+			return lambda album: album
+		if field == 'artist':
+			return self.albums['artist'].__getitem__
+		return self.albums[self.album_fields[field]].__getitem__
+	def _get_group_name(self,field,value):
+		if field == 'album':
+			return self.albums['name'][value]
+		if field == 'publisher':
+			return self.publishers.values[value]
+		if field in self.song_codes:
+			return getattr(self, self.song_codes[field]).values[value]
+		return value
+	def _count_groups(self,items,readers,read_distinct):
+		'''Counts the (item, songs) pairs in items by the key the
+		readers make of each item.'''
+		counts = {}
+		if read_distinct is None:
+			for item, n in items:
+				key = tuple([read(item) for read in readers])
+				counts[key] = counts.get(key, 0) + n
+			return counts
+		for item, n in items:
+			key = tuple([read(item) for read in readers])
+			counts.setdefault(key, set()).add(read_distinct(item))
+		for key, values in counts.iteritems():
+			# NULLs aren't counted as a value, as in SQL
+			values.discard(None)
+			counts[key] = len(values)
+		return counts
+	def aggregate(self,group_by,qdict=None,distinct=None):
+		fields = self._get_aggregate_fields(group_by,distinct)
+		with self.lock:
+			rows = self._match(self._get_conditions(qdict))
+			album_level = set(self.album_fields.keys() + ['artist'])
+			if distinct is None and len(fields) == 1 and fields[0] in self.song_indexes and rows is None:
+				# Counting the whole library is just the size of
+				# each entry in the field's index
+				index = self.song_indexes[fields[0]]
+				counts = self._count_groups(((value, len(value_rows) if isinstance(value_rows, set) else 1)
+								for value, value_rows in index.iteritems()),
+								[lambda value: value], None)
+			elif album_level.issuperset(fields + [distinct or 'album']):
+				# Everything needed is kept per album, so count the
+				# songs on each album and then group the albums
+				album_counts = {}
+				if rows is None:
+					for album, album_rows in self.song_indexes['album'].iteritems():
+						album_counts[album] = len(album_rows) if isinstance(album_rows, set) else 1
+				else:
+					album = self.songs['album']
+					for row in rows:
+						album_counts[album[row]] = album_counts.get(album[row], 0) + 1
+				counts = self._count_groups(album_counts.iteritems(),
+								[self._get_album_group_reader(field) for field in fields],
+								distinct and self._get_album_group_reader(distinct))
+			else:
+				if rows is None:
+					rows = self._all_rows()
+				counts = self._count_groups(((row, 1) for row in rows),
+								[self._get_group_reader(field) for field in fields],
+								distinct and self._get_group_reader(distinct))
+			results = []
+			for key, count in counts.iteritems():
+				result = dict([(field, self._get_group_name(field, value))
+							for field, value in zip(fields, key)])
+				result['count'] = count
+				results.append(result)
+		results.sort(key=lambda r: tuple([-r['count']] + [r[f] for f in fields]))
 		return results
 
+# Datastores which can be picked by name, e.g. with --datastore
+datastores = OrderedDict([
+	('sqlite', AFSqliteDataStore),
+	('memory', AFMemoryDataStore)
+])
+
+def register_datastore(name, cls):
+	'''Makes the AFDataStore subclass cls available as name.'''
+	datastores[name] = cls
+
+def get_datastore(name, *args, **kwargs):
+	'''Returns a new instance of the datastore registered as name,
+	created with the remaining arguments.'''
+	if name not in datastores:
+		raise ValueError('Unknown datastore "%s"; choose from %s' % (name, ', '.join(datastores)))
+	return datastores[name](*args, **kwargs)
+
+
+def get_file_fingerprint(path):
+	'''Returns the (size, mtime, inode) of a file, used to tell
+	whether the file has changed since it was added.'''
+	st = stat(path)
+	return (st.st_size, st.st_mtime, st.st_ino)
+
+def read_tag_record(args):
+	'''Reads the tags of the MP3 at args[0] (with library base
+	path args[1]) and returns them as a compact record, or None
+	if the file could not be read.  Runs in the worker processes
+	started by AFLibrary.add_mp3s().'''
+	try:
+		ent = AFLibraryEntry()
+		ent.apply_path(args[0], args[1])
+		return ent.get_record()
+	except Exception as e:
+		print 'Unable to read "%s": %s' % (args[0], e)
+		return None
+
+class AFBufferedWriter:
+	'''Buffers library entries and hands them to the datastore
+	in batches via save_mp3_batch().  A batch is written as soon
+	as batch_size entries are buffered or the oldest buffered
+	entry is linger_ms milliseconds old, whichever comes first.
+	Call flush() to write out whatever is left in the buffer.
+	An on_written callback passed to put() is called once the
+	batch holding that entry has been written.  Entries the
+	datastore can't save are left out of the batch and listed,
+	with the error, in failed.  If the whole batch can't be
+	written its entries are listed in failed, their on_failed
+	callbacks are called with the error and the error is raised;
+	the batch isn't kept for another try.
+	'''
+	def __init__(self,datastore,batch_size=500,linger_ms=1000):
+		self.datastore = datastore
+		self.batch_size = batch_size
+		self.linger_ms = linger_ms
+		self.buffer = []
+		self.callbacks = []
+		self.buffer_started = None
+		self.lock = Lock()
+		self.rows_written = 0
+		self.batches_written = 0
+		self.write_time = 0.0
+		self.failed = []
+	def put(self,entry,on_written=None,on_failed=None):
+		with self.lock:
+			if not self.buffer:
+				self.buffer_started = time()
+			self.buffer.append(entry)
+			self.callbacks.append((on_written, on_failed))
+			if len(self.buffer) >= self.batch_size or \
+				(time() - self.buffer_started) * 1000 >= self.linger_ms:
+				self._flush()
+	def flush(self):
+		with self.lock:
+			self._flush()
+	def flush_expired(self):
+		'''Writes the buffer if it has been waiting for longer
+		than linger_ms, for callers whose puts can stall.'''
+		with self.lock:
+			if self.buffer and \
+				(time() - self.buffer_started) * 1000 >= self.linger_ms:
+				self._flush()
+	def _flush(self):
+		if self.buffer:
+			buffer, callbacks = self.buffer, self.callbacks
+			self.buffer = []
+			self.callbacks = []
+			start = time()
+			errors = []
+			try:
+				self.rows_written += self.datastore.save_mp3_batch(buffer,errors)
+			except Exception as e:
+				for entry in buffer:
+					self.failed.append((entry.path, e))
+				for on_written, on_failed in callbacks:
+					if on_failed is not None:
+						on_failed(e)
+				raise
+			for entry, e in errors:
+				print 'Unable to save "%s": %s' % (entry.path, e)
+				self.failed.append((entry.path, e))
+			self.write_time += time() - start
+			self.batches_written += 1
+			for on_written, on_failed in callbacks:
+				if on_written is not None:
+					on_written()
+	def rows_per_sec(self):
+		if self.write_time:
+			return self.rows_written / self.write_time
+		return 0.0
+	def __str__(self):
+		text = 'Wrote %d songs in %d batches (%.1f rows/sec)' % \
+			(self.rows_written, self.batches_written, self.rows_per_sec())
+		if self.failed:
+			text += ', %d failed' % len(self.failed)
+		return text
+
+class AFStageStats:
+	'''Counters for one stage of an AFIngestPipeline: how many
+	items it handled, how long it spent working and how long it
+	spent waiting on its neighbouring stages.'''
+	def __init__(self,name):
+		self.name = name
+		self.items = 0
+		self.busy_time = 0.0
+		self.wait_time = 0.0
+	def items_per_sec(self):
+		if self.busy_time:
+			return self.items / self.busy_time
+		return 0.0
+	def __str__(self):
+		return '%s: %d items, %.1f items/sec while busy, %.1f sec busy, %.1f sec waiting' % \
+			(self.name, self.items, self.items_per_sec(), self.busy_time, self.wait_time)
+
+class AFIngestPipeline:
+	'''Adds MP3s to a datastore in three stages.  The find stage
+	produces paths, the parse stage reads tags in a pool of
+	n_workers processes, and a single writer thread saves the
+	entries in batches of batch_size (or whatever has arrived
+	within linger_ms).  Parsed entries reach the writer through
+	a queue of at most queue_size entries, so parsing stalls
+	rather than piling up when the datastore falls behind.
+	If paths raises (a directory which can't be listed), the
+	songs found so far are still written and run() then raises
+	the error.
+	Entries that can't be saved don't stop the ingest; they are
+	listed, with the error, in failed.
+	str() reports the statistics for each stage; the stage that
+	is busy while the others wait is the bottleneck.
+	'''
+	def __init__(self,datastore,n_workers=None,queue_size=2000,
+				batch_size=500,linger_ms=1000,chunk_size=32):
+		self.datastore = datastore
+		self.n_workers = n_workers
+		self.batch_size = batch_size
+		self.linger_ms = linger_ms
+		self.chunk_size = chunk_size
+		self.channel = Queue(queue_size)
+		self.find_stats = AFStageStats('find')
+		self.parse_stats = AFStageStats('parse')
+		self.write_stats = AFStageStats('write')
+		self.queue_samples = 0
+		self.queue_total = 0
+		self.queue_max = 0
+		self.elapsed = 0.0
+		self.failed = []
+		self.find_error = None
+	def _find(self,paths,base_path):
+		stats = self.find_stats
+		paths = iter(paths)
+		while True:
+			start = time()
+			try:
+				path = next(paths)
+			except StopIteration:
+				stats.busy_time += time() - start
+				return
+			except Exception:
+				# This runs in the pool's task thread, which can't
+				# pass the error on; run() raises it
+				self.find_error = sys.exc_info()
+				stats.busy_time += time() - start
+				return
+			stats.busy_time += time() - start
+			stats.items += 1
+			yield (path, base_path)
+	def _run_writer(self):
+		stats = self.write_stats
+		batch = []
+		batch_started = None
+		finished = False
+		while not finished:
+			timeout = None
+			if batch:
+				timeout = max(0, batch_started + self.linger_ms / 1000.0 - time())
+			start = time()
+			try:
+				ent = self.channel.get(True, timeout)
+			except Empty:
+				ent = False
+			stats.wait_time += time() - start
+			if ent is None:
+				finished = True
+			elif ent:
+				if not batch:
+					batch_started = time()
+				batch.append(ent)
+			if batch and (finished or len(batch) >= self.batch_size or \
+				time() - batch_started >= self.linger_ms / 1000.0):
+				start = time()
+				errors = []
+				try:
+					stats.items += self.datastore.save_mp3_batch(batch,errors)
+				except Exception as e:
+					# The whole batch was lost; carry on with the
+					# next one so the parse stage doesn't block.
+					errors = [(entry, e) for entry in batch]
+				for entry, e in errors:
+					print 'Unable to save "%s": %s' % (entry.path, e)
+					self.failed.append((entry.path, e))
+				stats.busy_time += time() - start
+				batch = []
+	def run(self,paths,base_path):
+		started = time()
+		writer = Thread(target=self._run_writer)
+		writer.start()
+		pool = Pool(self.n_workers)
+		parse = self.parse_stats
+		try:
+			try:
+				records = pool.imap_unordered(read_tag_record,
+								self._find(paths, base_path), self.chunk_size)
+				for record in records:
+					if record is None:
+						continue
+					parse.items += 1
+					ent = AFLibraryEntry()
+					ent.apply_record(record)
+					depth = self.channel.qsize()
+					self.queue_samples += 1
+					self.queue_total += depth
+					self.queue_max = max(self.queue_max, depth)
+					# Time spent blocked here is time the parse stage
+					# waited on the writer.
+					start = time()
+					self.channel.put(ent)
+					parse.wait_time += time() - start
+				parse.busy_time = time() - started - parse.wait_time
+				pool.close()
+			except:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+		finally:
+			self.channel.put(None)
+			writer.join()
+			self.elapsed = time() - started
+		if self.find_error is not None:
+			raise self.find_error[0], self.find_error[1], self.find_error[2]
+	def __str__(self):
+		avg = 0.0
+		if self.queue_samples:
+			avg = float(self.queue_total) / self.queue_samples
+		lines = [
+			str(self.find_stats),
+			str(self.parse_stats),
+			'queue: %.1f entries on average, %d at most, %d allowed' % \
+				(avg, self.queue_max, self.channel.maxsize),
+			str(self.write_stats),
+			'%d songs in %.1f sec (%.1f songs/sec)' % (self.write_stats.items,
+				self.elapsed, self.write_stats.items / self.elapsed if self.elapsed else 0.0)
+		]
+		if self.failed:
+			lines.append('%d songs failed to save' % len(self.failed))
+		return '\n'.join(lines)
 
 class AFLibrary:
 	'''Represents an audiofile library.
 	You can add an MP3 to the library via the add_mp3() method.
 	Execute a query on the library via the get_songs() method.
 	'''
-	def __init__(self, datastore):
+	def __init__(self, datastore, writer=None, query_cache=None):
 		self.datastore = datastore
+		self.writer = writer
+		self.query_cache = query_cache
 				
 	def initialize_db(self):
 		self.datastore.create_db()
 
-	def add_mp3(self, path, base_path):
+	def add_mp3(self, path, base_path, on_saved=None):
 		ent = AFLibraryEntry()
 		ent.apply_path(path, base_path)
-		self.datastore.save_mp3(ent)
+		self._save(ent, on_saved)
+
+	def add_record(self, record, on_saved=None, on_failed=None):
+		'''Adds a song from a record made by read_tag_record().
+		on_saved, if given, is called once the song is stored, and
+		on_failed, with the error, if a buffered write of it fails.'''
+		ent = AFLibraryEntry()
+		ent.apply_record(record)
+		self._save(ent, on_saved, on_failed)
+
+	def add_mp3s(self, paths, base_path, n_workers=None, batch_size=500, linger_ms=1000):
+		'''Adds many MP3s through an AFIngestPipeline, parsing them
+		in n_workers processes (one per CPU by default) and writing
+		them from a single writer thread.  Returns the pipeline so
+		its statistics can be reported.
+		'''
+		pipeline = AFIngestPipeline(self.datastore, n_workers,
+						batch_size=batch_size, linger_ms=linger_ms)
+		pipeline.run(paths, base_path)
+		return pipeline
+
+	def _save(self, ent, on_saved=None, on_failed=None):
+		if self.writer:
+			self.writer.put(ent, on_saved, on_failed)
+		else:
+			self.datastore.save_mp3(ent)
+			if on_saved is not None:
+				on_saved()
+
+	def flush(self):
+		if self.writer:
+			self.writer.flush()
+
+	def update_paths(self, moves):
+		'''Records renamed files, given as (old path, new path)
+		pairs, in the datastore.'''
+		moves = list(moves)
+		if moves:
+			# Anything still buffered may be saved under an old path
+			self.flush()
+			self.datastore.update_paths(moves)
+
+	def find_changed_files(self, paths, base_path):
+		'''Yields the paths which are new to the library or whose
+		size, mtime or inode no longer match what was stored when
+		they were added.  Songs whose files are no longer found
+		under base_path are marked as deleted once all of the
+		paths have been seen; if paths raises, nothing is marked.
+		'''
+		known = self.datastore.get_file_fingerprints(base_path)
+		for path in paths:
+			fingerprint = known.pop(path, None)
+			if fingerprint is not None:
+				if fingerprint == get_file_fingerprint(path):
+					continue
+				self.datastore.delete_paths([path])
+			yield path
+		if known:
+			self.datastore.delete_paths(known.keys())
 		
-	def get_songs(self, qdict):
-		for result in self.datastore.get_query_result_set(qdict):
-			ent = AFLibraryEntry()
-			ent.apply_dict(result)
-			yield ent
+	def aggregate(self, group_by, filters=None, distinct=None):
+		'''Counts songs (or, with distinct, the different values of
+		that field) per value of group_by among the songs matching
+		filters; see AFDataStore.aggregate().'''
+		return self.datastore.aggregate(group_by, filters, distinct)
+
+	def get_songs(self, qdict, order_by=None, limit=None, offset=None, after=None):
+		'''Returns an iterator over the songs matching qdict,
+		served from the query cache where there is one.  Songs
+		from the cache are shared between callers, so don't
+		modify them.  See AFDataStore.get_query_result_set() for
+		order_by, limit, offset and after.'''
+		paging = dict(order_by=order_by, limit=limit, offset=offset, after=after)
+		if self.query_cache is None:
+			return self.datastore.get_entries(qdict, **paging)
+		key = (AFQueryCache.make_key(qdict), tuple(order_by or ()), limit, offset, after)
+		# Read before querying, so a write made while the query
+		# runs leaves the cached result already stale
+		generation = self.datastore.generation
+		songs = self.query_cache.get(key, generation)
+		if songs is not None:
+			return iter(songs)
+		entries = self.datastore.get_entries(qdict, **paging)
+		songs = list(islice(entries, self.query_cache.max_rows + 1))
+		if len(songs) > self.query_cache.max_rows:
+			return chain(songs, entries)
+		self.query_cache.put(key, generation, songs)
+		return iter(songs)
+
+	def search_songs(self, text, limit=50):
+		'''Returns up to limit songs matching the words in text,
+		best match first.'''
+		for result in self.datastore.search(text, limit):
+			yield AFLibraryEntry.from_dict(result)
 		
 
-class AFLibraryEntry:
+class AFLibraryEntry(object):
 	'''Represents an audiofile library entry (a song).
 	Instances can be created from an MP3 file by suppling the
 	path to the MP3 file and the base path to the MP3 library via
 	the "apply_path() method, or from a dictionary with the
 	instance variable names as keys using the apply_dict() method.
+	from_row() and from_dict() build an entry straight from a query
+	result row or document.
+	Entries use __slots__ to keep them small; use to_dict() where
+	the attributes are needed as a dictionary.  id is the
+	datastore's key for a song read back from it, and None
+	otherwise; it is left out of to_dict().
 	'''
-	base_path = ''
-	path = ''
-	artist = ''
-	album = ''
-	title = ''
-	track_num = 0
-	total_tracks = 0
-	disc_num = 0
-	total_discs = 0
-	publisher = ''
-	year = ''
-	genre = ''
+	__slots__ = ('base_path', 'path', 'artist', 'album', 'title',
+		'track_num', 'total_tracks', 'disc_num', 'total_discs',
+		'publisher', 'year', 'genre', 'size', 'mtime', 'inode', 'id')
+	record_fields = ('path', 'base_path', 'artist', 'album', 'title',
+		'track_num', 'total_tracks', 'disc_num', 'total_discs',
+		'publisher', 'year', 'genre', 'size', 'mtime', 'inode')
+	# Order of the columns in AFDataStore.query_fields
+	row_fields = ('title', 'path', 'base_path', 'track_num', 'disc_num',
+		'album', 'total_tracks', 'total_discs', 'year', 'artist',
+		'publisher', 'genre', 'id')
 	def __init__(self):
-		pass
+		self.base_path = ''
+		self.path = ''
+		self.artist = ''
+		self.album = ''
+		self.title = ''
+		self.track_num = 0
+		self.total_tracks = 0
+		self.disc_num = 0
+		self.total_discs = 0
+		self.publisher = ''
+		self.year = ''
+		self.genre = ''
+		self.size = 0
+		self.mtime = 0
+		self.inode = 0
+		self.id = None
+	@classmethod
+	def from_row(cls,row):
+		ent = cls.__new__(cls)
+		(ent.title, ent.path, ent.base_path, ent.track_num, ent.disc_num,
+			ent.album, ent.total_tracks, ent.total_discs, ent.year,
+			ent.artist, ent.publisher, ent.genre, ent.id) = row
+		ent.size = ent.mtime = ent.inode = 0
+		return ent
+	@classmethod
+	def from_dict(cls,d):
+		ent = cls.__new__(cls)
+		ent.apply_dict(d)
+		ent.size = ent.mtime = ent.inode = 0
+		ent.id = d.get('id')
+		return ent
+	def to_dict(self):
+		return dict([(f, getattr(self, f)) for f in self.__slots__ if f != 'id'])
+	def get_record(self):
+		return tuple([getattr(self, f) for f in self.record_fields])
+	def apply_record(self,record):
+		for f, v in zip(self.record_fields, record):
+			setattr(self, f, v)
 	def apply_path(self,path,base_path):
 		self.base_path = base_path
 		if isfile(path):
-			mp3 = eyed3.load(path)
+			self.size, self.mtime, self.inode = get_file_fingerprint(path)
 			self.path = path
+			# Try the lightweight ID3v2 reader first; it only
+			# handles plain v2.3/v2.4 tags, and anything it can't
+			# make sense of is left to eyed3.
+			try:
+				frames = id3v2.read_frames(path)
+				if frames is not None:
+					self._apply_frames(frames)
+					return
+			except Exception:
+				pass
+			mp3 = eyed3.load(path)
 			if mp3.tag:
-				self.artist = mp3.tag.artist
-				self.album = mp3.tag.album
-				self.title = mp3.tag.title
-				self.track_num, self.total_tracks = mp3.tag.track_num
-				if not self.track_num:
-					self.total_tracks = None
-				self.disc_num, self.total_discs = mp3.tag.disc_num
-				if not self.total_discs:
-					self.total_discs = 1
-				if not self.disc_num:
-					self.disc_num = 1
-				self.publisher = mp3.tag.publisher
-				if not self.publisher:
-					self.publisher = '(Unknown)'
-				if mp3.tag.best_release_date:
-					self.year = str(mp3.tag.best_release_date)
-				if not self.year:
-					self.year = ''
+				genre = None
 				if mp3.tag.genre:
-					self.genre = mp3.tag.genre.name
+					genre = mp3.tag.genre.name
+				self._apply_tags(mp3.tag.artist, mp3.tag.album,
+					mp3.tag.title, mp3.tag.track_num, mp3.tag.disc_num,
+					mp3.tag.publisher, mp3.tag.best_release_date, genre)
+	def _apply_frames(self,frames):
+		genre = None
+		if frames.get('TCON'):
+			g = eyed3.id3.Genre.parse(frames['TCON'])
+			if g:
+				genre = g.name
+		year = None
+		for frame_id in ('TDRL', 'TDOR', 'TDRC', 'TYER'):
+			if frames.get(frame_id):
+				year = frames[frame_id]
+				break
+		self._apply_tags(frames.get('TPE1'), frames.get('TALB'),
+			frames.get('TIT2'), id3v2.parse_num_pair(frames.get('TRCK')),
+			id3v2.parse_num_pair(frames.get('TPOS')), frames.get('TPUB'),
+			year, genre)
+	def _apply_tags(self,artist,album,title,track_num,disc_num,publisher,year,genre):
+		self.artist = artist
+		self.album = album
+		self.title = title
+		self.track_num, self.total_tracks = track_num
+		if not self.track_num:
+			self.total_tracks = None
+		self.disc_num, self.total_discs = disc_num
+		if not self.total_discs:
+			self.total_discs = 1
+		if not self.disc_num:
+			self.disc_num = 1
+		self.publisher = publisher
+		if not self.publisher:
+			self.publisher = '(Unknown)'
+		if year:
+			self.year = str(year)
+		if not self.year:
+			self.year = ''
+		if genre:
+			self.genre = genre
 	def apply_dict(self,d):
 		self.title = d['title']
 		self.path = d['path']
@@ -312,14 +1899,10 @@ class Pattern:
 	%y = year
 	'''
 	def __init__(self, p):
-		for token in p.split('%'):
-			if len(token):
-				c = token[0]
-				if c != 'a' and c != 'b' and c != 't' and \
-					c != 'n' and c != 'N' and c != 'd' and \
-					c != 'D' and c != 'p' and c != 'g' and c != 'y':
-					raise ValueError
+		self.compiled = file_pattern.compile_pattern(p)
 		self.pattern = p
+	def render(self, song):
+		return self.compiled.render(song)
 		
 if __name__ == '__main__':
 	pass
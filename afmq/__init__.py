@@ -29,71 +29,276 @@ THE SOFTWARE.
 import sys
 import os
 
+from threading import Lock
+from time import time
+from multiprocessing import Pool, cpu_count
 import stomp
 import json
 
 import afutils.file_pattern as pattern
-from aflib3 import AFLibraryEntry
+from afutils.rename_planner import RenamePlanner
+from aflib3 import AFLibraryEntry, read_tag_record
+from threadpool import ThreadPool
 
 class AFMQ:
 	'''Represents a basic connection to an ActiveMQ
-	service for AudioFile.
+	service for AudioFile, used to post jobs to a queue.
+	Jobs are packed batch_size at a time into a single message,
+	which is sent once it is full or its oldest job is linger_ms
+	milliseconds old.  Call flush() (or close()) to send whatever
+	is left.
 	'''
-	def __init__(self, queue_name):
+	def __init__(self, queue_name, batch_size=1, linger_ms=1000):
 		self.queue_name = queue_name
+		self.batch_size = batch_size
+		self.linger_ms = linger_ms
+		self.batch = []
+		self.batch_started = None
+		self.n_jobs = 0
+		self.n_messages = 0
 		self.queue_handle = stomp.Connection()
 		self.queue_handle.start()
 		self.queue_handle.connect()
-		self.queue_handle.subscribe(destination=queue_name, ack='auto')
 	def __del__(self):
-		self.queue_handle.disconnect()
-	def put(self, msg):
-		self.queue_handle.send(msg, destination=self.queue_name)
+		self.close()
+	def close(self):
+		if self.queue_handle:
+			self.flush()
+			self.queue_handle.disconnect()
+			self.queue_handle = None
+	def put(self, job):
+		'''Queues job, which must be serializable as JSON.'''
+		if not self.batch:
+			self.batch_started = time()
+		self.batch.append(job)
+		if len(self.batch) >= self.batch_size or \
+			(time() - self.batch_started) * 1000 >= self.linger_ms:
+			self.flush()
+	def flush(self):
+		if self.batch:
+			self.queue_handle.send(json.dumps({'batch': self.batch}),
+							destination=self.queue_name)
+			self.n_jobs += len(self.batch)
+			self.n_messages += 1
+			self.batch = []
+	def __str__(self):
+		return 'Queued %d jobs in %d messages to %s' % \
+			(self.n_jobs, self.n_messages, self.queue_name)
+
+class MessageAck:
+	'''Acknowledges a message once each of the jobs it carried
+	has called done(), or NACKs it if any of them called fail()
+	instead.  Jobs can leave anything to be dealt with for the
+	message as a whole in results, which is handed to the
+	handler's complete() before the message is acknowledged.'''
+	def __init__(self, handler, headers, n_jobs):
+		self.handler = handler
+		self.headers = headers
+		self.remaining = n_jobs
+		self.failed = False
+		self.results = []
+		self.lock = Lock()
+	def done(self):
+		self._finish(False)
+	def fail(self):
+		self._finish(True)
+	def _finish(self, failed):
+		with self.lock:
+			self.failed = self.failed or failed
+			self.remaining -= 1
+			if self.remaining:
+				return
+		try:
+			self.handler.complete(self)
+		except Exception as e:
+			print '%s: Unable to complete message %s: %s' % \
+				(self.handler.__class__, self.headers['message-id'], e)
+			self.failed = True
+		if self.failed:
+			self.handler.nack(self.headers)
+		else:
+			self.handler.ack(self.headers)
+
+class JobDone:
+	'''Passes a job's done() or fail(), whichever comes first, on
+	to its MessageAck, so a job that fails after calling done(),
+	or fails twice, isn't counted twice.'''
+	def __init__(self, message_ack):
+		self.message_ack = message_ack
+		self.called = False
+		self.failed = False
+		self.lock = Lock()
+	def __call__(self):
+		with self.lock:
+			if self.called:
+				return
+			self.called = True
+		self.message_ack.done()
+	def fail(self, error=None):
+		with self.lock:
+			if self.failed:
+				return
+			self.failed = True
+			first = not self.called
+			self.called = True
+		self.message_ack.handler.job_failed()
+		if first:
+			self.message_ack.fail()
 		
 class BasicHandler:
 	'''Represents an ActiveMQ handler that consumes information
 	from the queue.
+	Messages are taken in client-individual ack mode with at most
+	prefetch of them unacknowledged at a time.  The jobs in each
+	message (a batch posted by AFMQ, or a single job) are handled
+	by a pool of n_workers threads.  Subclasses implement
+	handle(args, done) and call done() once the work for a job is
+	safely done; a message is acknowledged when all of its jobs
+	are, and one which never is will be redelivered when this
+	handler's connection goes away.  A job whose handle() raises,
+	or which calls done.fail(), is counted in n_failed and its
+	message is NACKed once its other jobs finish, so the broker
+	redelivers it instead of it holding a place in the prefetch
+	window.
 	'''
-	def __init__(self, aflib, queue_name):
+	def __init__(self, aflib, queue_name, prefetch=1, n_workers=1):
 		self.aflib = aflib
 		self.queue_name = queue_name
+		self.prefetch = prefetch
+		self.ack_lock = Lock()
+		self.n_acked = 0
+		self.n_nacked = 0
+		self.n_failed = 0
+		# Once the pool's queue is full the listener thread blocks,
+		# so no more than that is buffered beyond the prefetch window
+		self.pool = ThreadPool(self._handle, n_workers, n_workers * 4)
 		self.queue_handle = stomp.Connection()
 		self.queue_handle.set_listener(queue_name, self)
 		self.queue_handle.start()
 		self.queue_handle.connect()
-		self.queue_handle.subscribe(destination=queue_name, ack='auto')
+		self.queue_handle.subscribe(destination=queue_name, ack='client-individual',
+						headers={'activemq.prefetchSize': prefetch})
 	def __del__(self):
-		self.queue_handle.stop()
+		self.close()
+	def close(self):
+		'''Stops taking messages, finishes the ones already taken
+		and then disconnects.'''
+		if self.queue_handle:
+			self.queue_handle.unsubscribe(destination=self.queue_name)
+			self.pool.quit()
+			self.finish()
+			self.queue_handle.stop()
+			self.queue_handle = None
+	def finish(self):
+		'''Called by close() once every message taken has been
+		handled, before the connection is closed.'''
+		pass
+	def ack(self, headers):
+		with self.ack_lock:
+			self.queue_handle.ack({'message-id': headers['message-id']})
+			self.n_acked += 1
+	def nack(self, headers):
+		with self.ack_lock:
+			self.queue_handle.nack({'message-id': headers['message-id']})
+			self.n_nacked += 1
+	def job_failed(self):
+		with self.ack_lock:
+			self.n_failed += 1
 	def on_error(self, headers, message):
 		print '%s: Received an error: "%s"' % (self.__class__, message)
 	def on_message(self, headers, message):
-		print '%s: Received message: "%s"' % (self.__class__, message)
+		try:
+			args = json.loads(message)
+		except ValueError as e:
+			print '%s: Unable to read "%s": %s' % (self.__class__, message, e)
+			# It won't read any better if it is redelivered
+			self.ack(headers)
+			return
+		if isinstance(args, dict):
+			jobs = args['batch']
+		else:
+			jobs = [args]
+		if not jobs:
+			self.ack(headers)
+			return
+		print '%s: Received %d jobs' % (self.__class__, len(jobs))
+		message_ack = MessageAck(self, headers, len(jobs))
+		for job in jobs:
+			self.pool.put((job, message_ack))
+	def _handle(self, item):
+		args, message_ack = item
+		done = JobDone(message_ack)
+		try:
+			self.handle(args, done)
+		except Exception as e:
+			print '%s: Unable to handle %s: %s' % (self.__class__, args, e)
+			done.fail(e)
+	def handle(self, args, done):
+		raise NotImplementedError
+	def complete(self, message_ack):
+		'''Called once every job in a message has finished, with
+		the results they left; raise to have the message NACKed.'''
+		pass
 		
 class AddFileHandler(BasicHandler):
 	'''Adds files to the AudioFile library as the files
 	are posted into a queue.
+	Tags are read in a pool of n_workers processes, and each
+	job is done once its song has been written to the library.
+	With a buffered writer prefetch messages should carry more
+	files than the writer's batch size, or each batch waits out
+	the writer's linger time.
 	'''
-	def __init__(self, aflib):
-		BasicHandler.__init__(self, aflib, '/audiofile/library_additions')
-	def on_message(self, headers, message):
-		BasicHandler.on_message(self, headers, message)
-		args = json.loads(message)
-		self.aflib.add_mp3(args[0], args[1])
+	def __init__(self, aflib, prefetch=10, n_workers=None):
+		# Start the parser processes before any threads exist
+		self.parsers = Pool(n_workers)
+		BasicHandler.__init__(self, aflib, '/audiofile/library_additions',
+						prefetch, n_workers or cpu_count())
+	def handle(self, args, done):
+		record = self.parsers.apply(read_tag_record, ((args[0], args[1]),))
+		if record is None:
+			# A file which can't be read won't do any better if
+			# the message is redelivered
+			done()
+			return
+		self.aflib.add_record(record, done, done.fail)
+	def finish(self):
+		self.aflib.flush()
+		self.parsers.close()
+		self.parsers.join()
 		
 class RenameFileHandler(BasicHandler):
 	'''Renames files from the old path to the new specified
 	path as the information is put into a queue.
+	The new paths of the songs in a message are recorded in the
+	library together once all of its renames have been made,
+	including renames made before an earlier delivery of the
+	message was interrupted.
 	'''
-	def __init__(self, aflib):
-		BasicHandler.__init__(self, aflib, '/audiofile/file_renames')
-	def on_message(self, headers, message):
-		BasicHandler.on_message(self, headers, message)
-		args = json.loads(message)
+	def __init__(self, aflib, prefetch=4, n_workers=4):
+		self.planner = RenamePlanner()
+		BasicHandler.__init__(self, aflib, '/audiofile/file_renames',
+						prefetch, n_workers)
+	def handle(self, args, done):
 		song = AFLibraryEntry()
 		song.apply_dict(args[0])
 		newpath = pattern.get_new_path(song, args[1])
-		print 'Renaming "%s" as "%s"...' % (song.path, newpath)
-		os.rename(song.path, newpath)
+		if self.planner.rename(song.path, newpath):
+			print 'Renamed "%s" as "%s"' % (song.path, newpath)
+			with done.message_ack.lock:
+				done.message_ack.results.append((song.path, newpath))
+		else:
+			print 'Not renaming "%s" as "%s"' % (song.path, newpath)
+		done()
+	def complete(self, message_ack):
+		if message_ack.results:
+			try:
+				self.aflib.update_paths(message_ack.results)
+			except Exception:
+				self.planner.unrecorded(message_ack.results)
+				raise
+	def finish(self):
+		self.planner.finish()
 
 if __name__ == '__main__':
 	pass
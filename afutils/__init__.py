@@ -27,9 +27,19 @@ THE SOFTWARE.
 """
 
 import sys
-from os import walk
-from os.path import join, splitext
+import errno
+from os import listdir
+from os.path import join, splitext, isdir, islink
 from argparse import ArgumentParser
+from threading import Thread, Lock
+from Queue import Queue
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 
 def get_clargs(argv):
@@ -46,18 +56,166 @@ def get_clargs(argv):
 						help='''Rename MP3s according to a pattern''',
 						metavar='Pattern',
 						dest='pattern')
+	parser.add_argument('-s','--search',
+						help='Search song titles, artists and albums for words or the starts of words.',
+						metavar='Search text',
+						dest='search')
+	parser.add_argument('--order-by',
+						help='With --query, comma separated fields to sort by, each prefixed with - for descending order.',
+						type=lambda s: [f.strip() for f in s.split(',') if f.strip()],
+						dest='order_by')
+	parser.add_argument('--limit',
+						help='With --query or --search, the most songs to show.',
+						type=int,
+						dest='limit')
+	parser.add_argument('--offset',
+						help='With --query, the number of songs to skip.',
+						type=int,
+						dest='offset')
+	parser.add_argument('-c','--count-by',
+						help='Count songs per value of these comma separated fields, for the songs matching --query if given.',
+						metavar='Fields',
+						type=lambda s: [f.strip() for f in s.split(',') if f.strip()],
+						dest='count_by')
+	parser.add_argument('--distinct',
+						help='With --count-by, count the different values of this field (e.g. album) instead of songs.',
+						dest='distinct')
+	parser.add_argument('--datastore',
+						help='Where to keep the library: sqlite (the default for audiofile2), mongo (the default for audiofile3) or memory, which only lasts as long as the command.',
+						metavar='Name',
+						dest='datastore')
+	parser.add_argument('--explain',
+						help='With --query, show how the query is run and how long it takes instead of the songs.',
+						action='store_true',
+						dest='explain')
+	parser.add_argument('--incremental',
+						help='With --add, only read MP3s which are new or have changed since the last add.',
+						action='store_true',
+						dest='incremental')
+	parser.add_argument('-w','--workers',
+						help='Number of processes used to read MP3 tags when adding (default: one per CPU).',
+						type=int,
+						dest='workers')
+	parser.add_argument('--scan-threads',
+						help='Number of threads used to list directories when adding.',
+						type=int, default=4,
+						dest='scan_threads')
+	parser.add_argument('--batch-size',
+						help='Number of MP3s to write to the library per transaction.',
+						type=int, default=500,
+						dest='batch_size')
+	parser.add_argument('--message-batch',
+						help='Number of files or renames to send per queue message (audiofile3).',
+						type=int, default=100,
+						dest='message_batch')
+	parser.add_argument('--linger',
+						help='Milliseconds to wait for a batch to fill before writing or sending it.',
+						type=int, default=1000,
+						dest='linger_ms')
 	return vars(parser.parse_args(argv))
 
-def find_files_with_ext(dir, ext):
-	if not ext.startswith('.'):
-		ext = '.%s' % ext
-	for dirname, dirnames, filenames in walk(dir):
-		for filename in filenames:
-			if filename.startswith('.'):
-				continue
-			elif splitext(filename)[1].lower() != ext:
-				continue
-			yield join(dirname, filename)
+def find_files_with_ext(dir, ext, n_workers=1):
+	'''Yields the paths of the files under dir whose extension
+	is ext, or one of the extensions if ext is a list.  With
+	n_workers > 1, directories are listed by that many threads
+	and paths are yielded as soon as any thread finds them.'''
+	if isinstance(ext, basestring):
+		ext = [ext]
+	exts = set()
+	for e in ext:
+		if not e.startswith('.'):
+			e = '.%s' % e
+		exts.add(e.lower())
+	if n_workers > 1:
+		return _find_files_threaded(dir, exts, n_workers)
+	return _find_files(dir, exts)
+
+def _list_dir(dirname, exts):
+	'''Returns the matching files and the subdirectories to
+	descend into (symlinked directories are not followed, as
+	with os.walk()).  A directory which has gone away counts as
+	empty; any other error listing it is raised, as the songs
+	under it can't be told to be missing.'''
+	files = []
+	subdirs = []
+	try:
+		if scandir:
+			entries = [(e.name, e.path, e.is_dir(), e.is_dir() and e.is_symlink())
+						for e in scandir(dirname)]
+		else:
+			entries = []
+			for name in listdir(dirname):
+				path = join(dirname, name)
+				entries.append((name, path, isdir(path), isdir(path) and islink(path)))
+	except OSError as e:
+		if e.errno in (errno.ENOENT, errno.ENOTDIR):
+			return files, subdirs
+		raise
+	for name, path, is_dir, is_link in entries:
+		if is_dir:
+			if not is_link:
+				subdirs.append(path)
+		elif name.startswith('.'):
+			continue
+		elif splitext(name)[1].lower() in exts:
+			files.append(path)
+	return files, subdirs
+
+def _find_files(dir, exts):
+	pending = [dir]
+	while pending:
+		files, subdirs = _list_dir(pending.pop(), exts)
+		for f in files:
+			yield f
+		pending.extend(reversed(subdirs))
+
+def _find_files_threaded(dir, exts, n_workers):
+	dirs = Queue()
+	found = Queue()
+	lock = Lock()
+	state = {'pending': 1}
+	def run_thread():
+		while True:
+			dirname = dirs.get()
+			if dirname is None:
+				break
+			subdirs = []
+			try:
+				files, subdirs = _list_dir(dirname, exts)
+				for f in files:
+					found.put(f)
+			except Exception:
+				# Paths are strings, so a tuple can only be an error
+				# for the caller to raise
+				found.put(sys.exc_info())
+			finally:
+				# Always account for the directory, or the caller
+				# would wait for it forever
+				with lock:
+					state['pending'] += len(subdirs) - 1
+					done = state['pending'] == 0
+				for d in subdirs:
+					dirs.put(d)
+				if done:
+					found.put(None)
+	threads = [Thread(target=run_thread) for i in xrange(n_workers)]
+	for t in threads:
+		t.daemon = True
+		t.start()
+	dirs.put(dir)
+	try:
+		while True:
+			f = found.get()
+			if f is None:
+				break
+			if isinstance(f, tuple):
+				raise f[0], f[1], f[2]
+			yield f
+	finally:
+		for t in threads:
+			dirs.put(None)
+		for t in threads:
+			t.join()
 
 def extract_next(s,expect):
 	start = 1
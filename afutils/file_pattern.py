@@ -28,6 +28,7 @@ THE SOFTWARE.
 
 import sys
 import os
+from operator import attrgetter
 
 # Pattern for renaming MP3s:
 # %a = artist
@@ -41,51 +42,80 @@ import os
 # %g = genre
 # %y = year
 
+token_attrs = {
+	'a': 'artist',
+	'b': 'album',
+	't': 'title',
+	'n': 'track_num',
+	'N': 'total_tracks',
+	'd': 'disc_num',
+	'D': 'total_discs',
+	'p': 'publisher',
+	'g': 'genre',
+	'y': 'year'
+}
+
+class CompiledPattern:
+	'''A rename pattern compiled once into a format string for the
+	literal text and a single getter for all of its tokens, so
+	rendering the path for a song is one attribute fetch and one
+	string format.  Raises ValueError for an unknown token.'''
+	def __init__(self, p):
+		self.pattern = p
+		parts = []
+		attrs = []
+		have_token = False
+		for c in p:
+			if c == '%':
+				have_token = True
+			elif have_token:
+				if c not in token_attrs:
+					raise ValueError('Unknown pattern token %%%s' % c)
+				parts.append('%s')
+				attrs.append(token_attrs[c])
+				have_token = False
+			else:
+				parts.append(c.replace('%', '%%'))
+		self.format = ''.join(parts)
+		self.getter = None
+		if attrs:
+			get = attrgetter(*attrs)
+			if len(attrs) == 1:
+				self.getter = lambda song: (get(song),)
+			else:
+				self.getter = get
+	def render(self, song):
+		if self.getter is None:
+			return self.format
+		return self.format % self.getter(song)
+
+_compiled = {}
+
+def compile_pattern(p):
+	'''Returns the CompiledPattern for p, compiling it the first
+	time it is seen.'''
+	try:
+		return _compiled[p]
+	except KeyError:
+		cp = _compiled[p] = CompiledPattern(p)
+		return cp
+
 def is_valid(p):
-	for token in p.split('%'):
-		if len(token):
-			c = token[0]
-			if c != 'a' and c != 'b' and c != 't' and \
-				c != 'n' and c != 'N' and c != 'd' and \
-				c != 'D' and c != 'p' and c != 'g' and c != 'y':
-				return False
+	try:
+		compile_pattern(p)
+	except ValueError:
+		return False
 	return True
 	
 def get_new_path(song, p):
-	new_path = ''
-	have_token = False
-	for c in p:
-		if c == '%':
-			have_token = True
-		elif have_token:
-			new_path += get_value_for_token(song, c)
-			have_token = False
-		else:
-			new_path += c
-			have_token = False
-	return os.path.join(song.base_path, new_path)
+	return os.path.join(song.base_path, compile_pattern(p).render(song))
 	
 def get_value_for_token(song, token):
-	if token == 'a':
-		return song.artist
-	elif token == 'b':
-		return song.album
-	elif token == 't':
-		return song.title
-	elif token == 'n':
-		return str(song.track_num)
-	elif token == 'N':
-		return str(song.total_tracks)
-	elif token == 'd':
-		return str(song.disc_num)
-	elif token == 'D':
-		return str(song.total_discs)
-	elif token == 'p':
-		return song.publisher
-	elif token == 'g':
-		return song.genre
-	elif token == 'y':
-		return song.year
+	if token in token_attrs:
+		value = getattr(song, token_attrs[token])
+		if token in 'nNdD':
+			return str(value)
+		return value
 	
 if __name__ == '__main__':
 	pass
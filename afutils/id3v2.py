@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+id3v2.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import mmap
+import struct
+
+# Minimal ID3 v2.3/v2.4 reader for the handful of text frames the
+# library uses.  The file is mapped rather than read, so frames we
+# skip over (album art, mostly) never have to come off the disk.
+# Anything unusual - no ID3v2 header, v2.2 tags, unsynchronisation,
+# compressed or encrypted frames - makes read_frames() return None
+# and the caller should fall back to eyed3.
+
+wanted_frames = ('TPE1', 'TALB', 'TIT2', 'TRCK', 'TPOS', 'TPUB',
+	'TDRL', 'TDOR', 'TDRC', 'TYER', 'TCON')
+
+text_encodings = {
+	0: 'latin-1',
+	1: 'utf-16',
+	2: 'utf-16-be',
+	3: 'utf-8'
+}
+
+def read_frames(path):
+	'''Returns a dictionary of frame id to text for the wanted
+	frames in the ID3v2 tag of the file at path, or None if the
+	tag can't be handled here.'''
+	with open(path, 'rb') as f:
+		header = f.read(10)
+		if len(header) < 10 or header[:3] != 'ID3':
+			return None
+		f.seek(0, 2)
+		file_size = f.tell()
+		tag_size = _syncsafe(header[6:10])
+		if 10 + tag_size > file_size:
+			return None
+		m = mmap.mmap(f.fileno(), 10 + tag_size, access=mmap.ACCESS_READ)
+		try:
+			return _parse_tag(m, ord(header[3]), ord(header[5]), 10 + tag_size)
+		except (ValueError, struct.error, UnicodeDecodeError):
+			return None
+		finally:
+			m.close()
+
+def _parse_tag(data, version, flags, end):
+	if version not in (3, 4) or flags & 0x80:
+		return None
+	pos = 10
+	if flags & 0x40:
+		if version == 4:
+			pos += _syncsafe(data[pos:pos + 4])
+		else:
+			pos += 4 + struct.unpack('>I', data[pos:pos + 4])[0]
+	frames = {}
+	while pos + 10 <= end:
+		frame_id = data[pos:pos + 4]
+		if frame_id[0] == '\x00':
+			# Padding
+			break
+		if version == 4:
+			size = _syncsafe(data[pos + 4:pos + 8])
+			# Grouping (0x40) adds a byte before the text; the low
+			# bits are compression, encryption, unsynchronisation
+			# and a data length indicator
+			unsupported = ord(data[pos + 9]) & 0x4f
+		else:
+			size = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+			unsupported = ord(data[pos + 9]) & 0xe0
+		pos += 10
+		if pos + size > end:
+			raise ValueError('frame %s runs past the end of the tag' % frame_id)
+		if frame_id in wanted_frames and frame_id not in frames:
+			if unsupported:
+				return None
+			frames[frame_id] = _decode_text(data[pos:pos + size])
+		pos += size
+	return frames
+
+def _decode_text(data):
+	if not data:
+		return None
+	encoding = text_encodings.get(ord(data[0]))
+	if encoding is None:
+		raise ValueError('unknown text encoding %d' % ord(data[0]))
+	text = data[1:]
+	if encoding.startswith('utf-16') and len(text) % 2:
+		text = text[:-1]
+	# v2.4 allows several null separated values; keep the first
+	text = text.decode(encoding).split(u'\x00')[0]
+	return text or None
+
+def _syncsafe(data):
+	b = [ord(c) for c in data]
+	return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+def parse_num_pair(text):
+	'''Parses an "n/total" string (TRCK, TPOS) into a tuple of
+	ints, using None for any part which is missing.'''
+	if not text:
+		return (None, None)
+	parts = text.split('/', 1)
+	num = int(parts[0]) if parts[0].strip() else None
+	total = None
+	if len(parts) > 1 and parts[1].strip():
+		total = int(parts[1])
+	return (num, total)
+
+
+if __name__ == '__main__':
+	# Quick comparison against eyed3: python -m afutils.id3v2 file.mp3 ...
+	from time import time
+	import eyed3
+	paths = sys.argv[1:]
+	start = time()
+	for p in paths:
+		read_frames(p)
+	fast = time() - start
+	start = time()
+	for p in paths:
+		eyed3.load(p)
+	full = time() - start
+	if paths:
+		print 'id3v2: %.3f ms/file, eyed3: %.3f ms/file (%.1fx)' % \
+			(fast * 1000 / len(paths), full * 1000 / len(paths),
+			full / fast if fast else 0)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+rename_planner.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import os
+import errno
+from threading import Lock
+from collections import OrderedDict
+
+from threadpool import ThreadPool
+import afutils.file_pattern as pattern
+
+# A rename run is planned in full before anything on disk changes:
+# every song's target path is computed first, and any song whose
+# target is claimed by another song or already exists on disk is
+# held back as a collision rather than overwriting something.  Each
+# rename is written to a journal before it is made, so if a run is
+# interrupted the next run over the same library can tell the songs
+# that were already moved from the ones which have gone missing, and
+# hand them back to be recorded in the library.  The journal is only
+# removed by finish(), once the caller has recorded the new paths.
+
+class DirectoryCache:
+	'''Creates directories on demand, remembering the ones that
+	are known to exist so each is only created (or stat'ed) once.'''
+	def __init__(self):
+		self.known = set()
+		self.lock = Lock()
+		self.n_created = 0
+	def ensure(self, d):
+		if not d or d in self.known:
+			return
+		with self.lock:
+			if d in self.known:
+				return
+			try:
+				os.makedirs(d)
+				self.n_created += 1
+			except OSError as e:
+				if e.errno != errno.EEXIST or not os.path.isdir(d):
+					raise
+			self.known.add(d)
+
+class RenamePlanner:
+	'''Plans and runs the renames for a set of songs.  Use plan()
+	(or add() for each rename) to compute the target paths, then
+	execute() to run the planned renames in parallel.  rename()
+	plans and runs a single rename for callers which see songs
+	one at a time.  Pass journal_path=None to run without a
+	journal.'''
+	def __init__(self, journal_path='~/.audiofile/rename.journal'):
+		self.journal_path = None
+		self.journal = None
+		self.journaled = {}
+		if journal_path:
+			self.journal_path = os.path.expanduser(journal_path)
+			self.journaled = self._read_journal()
+		self.dirs = DirectoryCache()
+		self.lock = Lock()
+		self.moves = OrderedDict()
+		self.contested = set()
+		self.noops = []
+		self.collisions = []
+		self.missing = []
+		self.completed = []
+		self.failed = []
+		self.unfinished = set()
+	def _read_journal(self):
+		journaled = {}
+		try:
+			with open(self.journal_path, 'rb') as f:
+				for line in f:
+					line = line.rstrip('\n').decode('utf-8')
+					if '\t' in line:
+						src, dst = line.split('\t', 1)
+						journaled[src] = dst
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		return journaled
+	def _open_journal(self):
+		if self.journal_path and self.journal is None:
+			self.dirs.ensure(os.path.dirname(self.journal_path))
+			self.journal = open(self.journal_path, 'ab')
+	def _write_journal(self, src, dst):
+		if self.journal is not None:
+			with self.lock:
+				self.journal.write((u'%s\t%s\n' % (src, dst)).encode('utf-8'))
+				self.journal.flush()
+				self.journaled[src] = dst
+				self.unfinished.add((src, dst))
+	def plan(self, songs, p):
+		'''Plans renaming each of songs according to the pattern p.'''
+		for song in songs:
+			self.add(song.path, pattern.get_new_path(song, p))
+		return self
+	def add(self, src, dst):
+		'''Plans renaming src to dst.  Returns True if the rename
+		is to be made, or False if it was a no-op, a collision, a
+		missing file or a rename already made by an earlier run.'''
+		with self.lock:
+			if src == dst:
+				self.noops.append(src)
+				return False
+			if self._made_earlier(src, dst):
+				self.completed.append((src, dst))
+				return False
+			if dst in self.contested:
+				self.collisions.append((src, dst, 'target claimed by more than one song'))
+				return False
+			if dst in self.moves:
+				# Neither song gets the target
+				self.collisions.append((self.moves.pop(dst), dst, 'target claimed by more than one song'))
+				self.collisions.append((src, dst, 'target claimed by more than one song'))
+				self.contested.add(dst)
+				return False
+			if not os.path.exists(src):
+				self.missing.append(src)
+				return False
+			if os.path.exists(dst):
+				self.collisions.append((src, dst, 'target already exists'))
+				return False
+			self.moves[dst] = src
+			return True
+	def _made_earlier(self, src, dst):
+		return self.journaled.get(src) == dst and \
+			not os.path.exists(src) and os.path.exists(dst)
+	def _rename(self, move):
+		src, dst = move
+		try:
+			self.dirs.ensure(os.path.dirname(dst))
+			if os.path.exists(dst):
+				with self.lock:
+					self.collisions.append((src, dst, 'target already exists'))
+				return False
+			self._write_journal(src, dst)
+			os.rename(src, dst)
+		except (OSError, IOError) as e:
+			with self.lock:
+				self.failed.append((src, dst, e))
+			return False
+		except Exception as e:
+			# Anything else would be swallowed by the thread pool
+			# along with the rest of the chunk
+			print 'Unable to rename "%s": %s' % (src, e)
+			with self.lock:
+				self.failed.append((src, dst, e))
+			return False
+		with self.lock:
+			self.completed.append((src, dst))
+			self.unfinished.discard((src, dst))
+		return True
+	def _rename_chunk(self, moves):
+		for move in moves:
+			self._rename(move)
+	def execute(self, n_threads=4):
+		'''Runs the planned renames using n_threads threads.
+		Returns the list of (old path, new path) pairs that were
+		renamed, including any made by an interrupted earlier run.
+		Call finish() once the new paths have been recorded.'''
+		self._open_journal()
+		moves = [(src, dst) for dst, src in self.moves.iteritems()]
+		self.moves.clear()
+		# Create the directories first, once each, so the renames
+		# themselves don't contend for the cache lock
+		for d in set(os.path.dirname(dst) for src, dst in moves):
+			self.dirs.ensure(d)
+		# Renames are cheap on a local disk, so hand them to the
+		# threads in chunks rather than paying for a queue handoff
+		# per file
+		chunk_size = max(1, min(64, len(moves) / (n_threads * 4)))
+		tp = ThreadPool(self._rename_chunk, n_threads)
+		try:
+			for i in xrange(0, len(moves), chunk_size):
+				tp.put(moves[i:i + chunk_size])
+			tp.drain()
+		finally:
+			tp.quit()
+		return self.completed
+	def rename(self, src, dst):
+		'''Plans and immediately makes a single rename.  Returns
+		True if the file was renamed, here or by an earlier run
+		whose rename is in the journal, so that its new path
+		should be recorded.'''
+		if not self.add(src, dst):
+			with self.lock:
+				return self._made_earlier(src, dst)
+		self._open_journal()
+		with self.lock:
+			self.moves.pop(dst, None)
+		return self._rename((src, dst))
+	def unrecorded(self, moves):
+		'''Notes renames whose new paths the caller was unable to
+		record, so that finish() keeps the journal for the next run
+		to hand them back.'''
+		with self.lock:
+			self.unfinished.update(moves)
+	def finish(self):
+		'''Closes the journal, removing it only if every rename
+		written to it is known to have been made.'''
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
+			if not self.failed and not self.unfinished:
+				os.remove(self.journal_path)
+				self.journaled = {}
+	def __str__(self):
+		return '%d renamed, %d planned, %d unchanged, %d collisions, %d missing, %d failed, %d directories created' % \
+			(len(self.completed), len(self.moves), len(self.noops), len(self.collisions),
+			len(self.missing), len(self.failed), self.dirs.n_created)
+
+if __name__ == '__main__':
+	pass
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_connections.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# Ingests songs into a fresh SQLite library in batches while reader
+# threads query it by artist, and reports the ingest rate and the
+# readers' query latency.  The library is made in a temporary
+# directory, which is also used as HOME so that older versions of
+# the datastore, without a dbname argument, put it there as well.
+# Usage:
+#   python bench_connections.py [songs] [readers] [batch size]
+
+import sys
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+
+def make_record(i):
+	album = i // 100
+	return ('/music/%d.mp3' % i, '/music', 'Artist%d' % (album // 10),
+		'Album%d' % album, 'Song%d' % i, i % 100 + 1, 100, 1, 1,
+		'Publisher', '1999', 'Rock', 1, 1.0, i)
+
+def main(args):
+	n = int(args[0]) if args else 200000
+	n_readers = int(args[1]) if len(args) > 1 else 4
+	batch_size = int(args[2]) if len(args) > 2 else 2000
+	tmpdir = tempfile.mkdtemp()
+	os.environ['HOME'] = tmpdir
+	from aflib2 import AFSqliteDataStore, AFLibraryEntry
+	try:
+		try:
+			ds = AFSqliteDataStore(dbname=os.path.join(tmpdir, 'lib.db'))
+		except TypeError:
+			ds = AFSqliteDataStore()
+		ds.create_db()
+		stop = []
+		latencies = []
+		def reader():
+			i = 0
+			while not stop:
+				start = time()
+				for result in ds.get_query_result_set({'artist': 'Artist%d' % (i % 200)}):
+					pass
+				latencies.append(time() - start)
+				i += 1
+		readers = [threading.Thread(target=reader) for i in xrange(n_readers)]
+		for t in readers:
+			t.start()
+		start = time()
+		batch = []
+		for i in xrange(n):
+			ent = AFLibraryEntry()
+			ent.apply_record(make_record(i))
+			batch.append(ent)
+			if len(batch) == batch_size:
+				ds.save_mp3_batch(batch)
+				batch = []
+		ds.save_mp3_batch(batch)
+		elapsed = time() - start
+		stop.append(True)
+		for t in readers:
+			t.join()
+		latencies.sort()
+		print 'Ingested %d songs in %.1f sec (%.0f songs/sec)' % (n, elapsed, n / elapsed)
+		if latencies:
+			print '%d readers ran %d queries: median %.2f ms, 99th percentile %.2f ms' % \
+				(n_readers, len(latencies), latencies[len(latencies) // 2] * 1000,
+				latencies[int(len(latencies) * 0.99)] * 1000)
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
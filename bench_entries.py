@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_entries.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# Measures the memory and build time of AFLibraryEntry instances,
+# as made from query rows and documents.  Runs against older trees
+# too, where entries can only be built with apply_dict().  Usage:
+#   python bench_entries.py [aflib2|aflib3] [count]
+
+import sys
+import gc
+import resource
+from time import time
+
+def main(args):
+	mod = __import__(args[0] if args else 'aflib2')
+	n = int(args[1]) if len(args) > 1 else 300000
+	AFLibraryEntry = mod.AFLibraryEntry
+	d = {'title': 'Song', 'path': '/music/x.mp3', 'base_path': '/music',
+		'track_num': 3, 'disc_num': 1, 'album': 'Album', 'total_tracks': 10,
+		'total_discs': 1, 'year': '1999', 'artist': 'Artist',
+		'publisher': 'Publisher', 'genre': 'Rock', 'id': 1}
+	def from_dict(d):
+		ent = AFLibraryEntry()
+		ent.apply_dict(d)
+		return ent
+	gc.collect()
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	keep = [from_dict(d) for i in xrange(n)]
+	after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is in kilobytes on Linux
+	print '%s: about %d bytes per entry' % (mod.__name__, (after - before) * 1024 / n)
+	del keep
+	if hasattr(AFLibraryEntry, 'from_row'):
+		row = tuple([d[f] for f in AFLibraryEntry.row_fields])
+		start = time()
+		for i in xrange(n):
+			AFLibraryEntry.from_row(row)
+		print 'from_row: %.2f us per entry' % ((time() - start) * 1e6 / n)
+		start = time()
+		for i in xrange(n):
+			AFLibraryEntry.from_dict(d)
+		print 'from_dict: %.2f us per entry' % ((time() - start) * 1e6 / n)
+	start = time()
+	for i in xrange(n):
+		ent = AFLibraryEntry()
+		ent.apply_dict(d)
+	print 'apply_dict: %.2f us per entry' % ((time() - start) * 1e6 / n)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
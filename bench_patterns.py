@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_patterns.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# Times rendering a rename pattern for a song and validating the
+# pattern.  Usage:
+#   python bench_patterns.py [pattern] [count]
+
+import sys
+from time import time
+
+import afutils.file_pattern as pattern
+from aflib2 import AFLibraryEntry
+
+def main(args):
+	p = args[0] if args else '%a/%b/%d.%n-%t-%b-%a.mp3'
+	n = int(args[1]) if len(args) > 1 else 100000
+	song = AFLibraryEntry()
+	song.artist = 'Scorpions'
+	song.album = 'Blackout'
+	song.title = 'Arizona'
+	song.track_num = 7
+	song.disc_num = 1
+	song.year = '1982'
+	song.genre = 'Rock'
+	song.path = '/music/x.mp3'
+	song.base_path = '/music'
+	print pattern.get_new_path(song, p)
+	start = time()
+	for i in xrange(n):
+		pattern.get_new_path(song, p)
+	print 'get_new_path: %.2f us per song' % ((time() - start) * 1e6 / n)
+	start = time()
+	for i in xrange(n):
+		pattern.is_valid(p)
+	print 'is_valid: %.2f us' % ((time() - start) * 1e6 / n)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
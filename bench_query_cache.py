@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_query_cache.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# Times repeated AFLibrary.get_songs() calls with and without an
+# AFQueryCache over a synthetic SQLite library, then checks that a
+# save invalidates the cached result.  Artists have 1000 songs and
+# albums 100.  Usage:
+#   python bench_query_cache.py [songs] [runs]
+
+import sys
+import os
+import shutil
+import tempfile
+from time import time
+
+from aflib2 import AFSqliteDataStore, AFLibrary, AFQueryCache, AFLibraryEntry
+
+def make_record(i):
+	album = i // 100
+	return ('/music/%d.mp3' % i, '/music', 'Artist%d' % (album // 10),
+		'Album%d' % album, 'Song%d' % i, i % 100 + 1, 100, 1, 1,
+		'Publisher%d' % (album % 50), str(1950 + album % 70),
+		'Genre%d' % (album % 30), 1, 1.0, i)
+
+def time_query(lib, qdict, runs):
+	start = time()
+	for i in xrange(runs):
+		songs = list(lib.get_songs(qdict))
+	return (time() - start) * 1000 / runs, len(songs)
+
+def main(args):
+	n = int(args[0]) if args else 1000000
+	runs = int(args[1]) if len(args) > 1 else 200
+	tmpdir = tempfile.mkdtemp()
+	try:
+		ds = AFSqliteDataStore(dbname=os.path.join(tmpdir, 'lib.db'))
+		ds.create_db()
+		batch = []
+		for i in xrange(n):
+			ent = AFLibraryEntry()
+			ent.apply_record(make_record(i))
+			batch.append(ent)
+			if len(batch) == 20000:
+				ds.save_mp3_batch(batch)
+				batch = []
+		ds.save_mp3_batch(batch)
+		plain = AFLibrary(ds)
+		cached = AFLibrary(ds, query_cache=AFQueryCache())
+		for qdict in [{'artist': 'Artist12'}, {'genre': 'Genre3', 'year': '1990'}, {'album': 'Album77'}]:
+			uncached_ms, count = time_query(plain, qdict, runs)
+			cached_ms, count = time_query(cached, qdict, runs)
+			print '%r (%d songs): %.3f ms uncached, %.3f ms cached' % (qdict, count, uncached_ms, cached_ms)
+		ent = AFLibraryEntry()
+		ent.apply_record(('/music/new.mp3', '/music', 'Artist12', 'Album120', 'New',
+						1, 1, 1, 1, 'Publisher', '1999', 'Rock', 1, 1.0, n))
+		before = len(list(cached.get_songs({'artist': 'Artist12'})))
+		ds.save_mp3(ent)
+		after = len(list(cached.get_songs({'artist': 'Artist12'})))
+		print 'After a save for Artist12: %d songs, then %d' % (before, after)
+		print cached.query_cache
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
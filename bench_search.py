@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_search.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Times AFSqliteDataStore.search() through the full text index and
+# through the LIKE scan used by SQLite builds without FTS5, over a
+# synthetic library.  Artists have 1000 songs and albums 100.
+# Usage:
+#   python bench_search.py [songs] [runs]
+
+import sys
+import os
+import shutil
+import tempfile
+from time import time
+
+from aflib2 import AFSqliteDataStore, AFLibraryEntry
+
+def make_record(i):
+	album = i // 100
+	return ('/music/%d.mp3' % i, '/music', 'Artist%d' % (album // 10),
+		'Album%d' % album, 'Song%d' % i, i % 100 + 1, 100, 1, 1,
+		'Publisher%d' % (album % 50), str(1950 + album % 70),
+		'Genre%d' % (album % 30), 1, 1.0, i)
+
+def time_search(ds, text, runs):
+	start = time()
+	for i in xrange(runs):
+		count = len(list(ds.search(text, 50)))
+	return (time() - start) * 1000 / runs, count
+
+def main(args):
+	n = int(args[0]) if args else 1000000
+	runs = int(args[1]) if len(args) > 1 else 10
+	tmpdir = tempfile.mkdtemp()
+	try:
+		ds = AFSqliteDataStore(dbname=os.path.join(tmpdir, 'lib.db'))
+		ds.create_db()
+		if not ds.have_search_index:
+			print 'This SQLite has no FTS5, so both runs would be LIKE scans'
+			return
+		batch = []
+		for i in xrange(n):
+			ent = AFLibraryEntry()
+			ent.apply_record(make_record(i))
+			batch.append(ent)
+			if len(batch) == 20000:
+				ds.save_mp3_batch(batch)
+				batch = []
+		ds.save_mp3_batch(batch)
+		mid = n // 2
+		album = mid // 100
+		searches = ['artist%d song%d' % (album // 10, mid), 'album%d' % album,
+			'nosuchsong', 'artist1']
+		for text in searches:
+			ds.have_search_index = True
+			fts_ms, fts_count = time_search(ds, text, runs)
+			# Forces the fallback used where there is no index
+			ds.have_search_index = False
+			like_ms, like_count = time_search(ds, text, runs)
+			print '%r: full text %.3f ms (%d songs), LIKE %.3f ms (%d songs)' % \
+				(text, fts_ms, fts_count, like_ms, like_count)
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
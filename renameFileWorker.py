@@ -35,12 +35,13 @@ from aflib3 import AFLibrary, AFMongoDataStore
 from afmq import RenameFileHandler
 
 def main():
-	RenameFileHandler(AFLibrary(AFMongoDataStore()))
+	handler = RenameFileHandler(AFLibrary(AFMongoDataStore()))
 	try:
 		while (True):
 			sleep(1)
 	except KeyboardInterrupt:
 		pass
+	handler.close()
 
 if __name__ == '__main__':
 	main()
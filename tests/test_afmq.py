@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_afmq.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from time import sleep
+from functools import partial
+from threading import Thread, Condition, Event
+
+import afmq
+import aflib2
+import aflib3
+from afutils.rename_planner import RenamePlanner
+from test_id3v2 import make_tag, AUDIO
+
+class StubConnection:
+	'''Stands in for stomp.Connection, behaving like a broker with
+	one client-individual subscription: at most prefetch messages
+	are delivered without being acknowledged, and they are handed
+	to the listener from a receiver thread as stomp.py does.'''
+	def __init__(self):
+		self.cond = Condition()
+		self.listener = None
+		self.prefetch = None
+		self.waiting = []
+		self.unacked = set()
+		self.acked = []
+		self.nacked = []
+		self.sent = []
+		self.n_delivered = 0
+		self.next_id = 0
+		self.running = False
+		self.delivering = False
+		self.receiver = None
+	def set_listener(self, name, listener):
+		self.listener = listener
+	def start(self):
+		self.running = True
+		self.receiver = Thread(target=self._receive)
+		self.receiver.daemon = True
+		self.receiver.start()
+	def connect(self):
+		pass
+	def subscribe(self, destination, ack, headers):
+		assert ack == 'client-individual'
+		with self.cond:
+			self.prefetch = int(headers['activemq.prefetchSize'])
+			self.cond.notify_all()
+	def unsubscribe(self, destination):
+		with self.cond:
+			self.prefetch = None
+			while self.delivering:
+				self.cond.wait()
+	def stop(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+		self.receiver.join()
+	def disconnect(self):
+		self.stop()
+	def send(self, body, destination):
+		self.sent.append((destination, body))
+	def ack(self, headers):
+		with self.cond:
+			self.unacked.remove(headers['message-id'])
+			self.acked.append(headers['message-id'])
+			self.cond.notify_all()
+	def nack(self, headers):
+		with self.cond:
+			self.unacked.remove(headers['message-id'])
+			self.nacked.append(headers['message-id'])
+			self.cond.notify_all()
+	def deliver(self, body):
+		'''Queues a message on the broker and returns its id.'''
+		with self.cond:
+			self.next_id += 1
+			message_id = 'msg-%d' % self.next_id
+			self.waiting.append((message_id, body))
+			self.cond.notify_all()
+		return message_id
+	def wait_for(self, test, timeout=5):
+		with self.cond:
+			for i in xrange(int(timeout * 100)):
+				if test():
+					return True
+				self.cond.wait(0.01)
+			return test()
+	def _receive(self):
+		while True:
+			with self.cond:
+				while self.running and not (self.waiting and self.prefetch and \
+								len(self.unacked) < self.prefetch):
+					self.cond.wait()
+				if not self.running:
+					return
+				message_id, body = self.waiting.pop(0)
+				self.unacked.add(message_id)
+				self.n_delivered += 1
+				self.delivering = True
+			try:
+				self.listener.on_message({'message-id': message_id}, body)
+			finally:
+				with self.cond:
+					self.delivering = False
+					self.cond.notify_all()
+
+class StubHandler(afmq.BasicHandler):
+	'''Handles jobs of the form [action] where action is "ok",
+	"fail", "fail-later" (reports the failure through done.fail()),
+	"done-then-fail" or "wait" (done once release is set).'''
+	def __init__(self, prefetch, n_workers):
+		self.release = Event()
+		self.handled = []
+		afmq.BasicHandler.__init__(self, None, '/test/queue', prefetch, n_workers)
+	def handle(self, args, done):
+		action = args[0]
+		self.handled.append(action)
+		if action == 'wait':
+			self.release.wait(5)
+		elif action == 'fail':
+			raise ValueError('bad job')
+		elif action == 'fail-later':
+			done.fail(ValueError('bad job'))
+			return
+		elif action == 'done-then-fail':
+			done()
+			raise ValueError('bad job after done')
+		done()
+
+class BasicHandlerTest(unittest.TestCase):
+	def setUp(self):
+		self.real_connection = afmq.stomp.Connection
+		afmq.stomp.Connection = StubConnection
+		self.handlers = []
+	def tearDown(self):
+		for handler in self.handlers:
+			handler.release.set()
+			handler.close()
+		afmq.stomp.Connection = self.real_connection
+	def make_handler(self, prefetch=1, n_workers=2):
+		handler = StubHandler(prefetch, n_workers)
+		self.handlers.append(handler)
+		return handler, handler.queue_handle
+	def test_batch_acked_once_all_jobs_are_done(self):
+		handler, conn = self.make_handler()
+		message_id = conn.deliver(json.dumps({'batch': [['ok'], ['ok'], ['ok']]}))
+		self.assertTrue(conn.wait_for(lambda: conn.acked))
+		self.assertEqual(conn.acked, [message_id])
+		self.assertEqual(handler.n_acked, 1)
+		self.assertEqual(len(handler.handled), 3)
+	def test_single_job_message(self):
+		handler, conn = self.make_handler()
+		message_id = conn.deliver(json.dumps(['ok']))
+		self.assertTrue(conn.wait_for(lambda: conn.acked))
+		self.assertEqual(conn.acked, [message_id])
+	def test_subscribes_with_prefetch(self):
+		handler, conn = self.make_handler(prefetch=3)
+		self.assertEqual(conn.prefetch, 3)
+	def test_prefetch_limits_unacked_messages(self):
+		handler, conn = self.make_handler(prefetch=2, n_workers=4)
+		for i in xrange(4):
+			conn.deliver(json.dumps(['wait']))
+		self.assertTrue(conn.wait_for(lambda: len(handler.handled) == 2))
+		self.assertFalse(conn.wait_for(lambda: conn.n_delivered > 2, timeout=0.2))
+		self.assertEqual(conn.acked, [])
+		handler.release.set()
+		self.assertTrue(conn.wait_for(lambda: len(conn.acked) == 4))
+		self.assertEqual(conn.n_delivered, 4)
+	def test_failed_job_is_nacked(self):
+		handler, conn = self.make_handler(prefetch=1)
+		failed = conn.deliver(json.dumps({'batch': [['ok'], ['fail']]}))
+		after = conn.deliver(json.dumps(['ok']))
+		self.assertTrue(conn.wait_for(lambda: conn.nacked and conn.acked))
+		self.assertEqual(conn.nacked, [failed])
+		self.assertEqual(conn.acked, [after])
+		self.assertEqual(handler.n_failed, 1)
+		self.assertEqual(handler.n_acked, 1)
+		self.assertEqual(handler.n_nacked, 1)
+	def test_job_reporting_failure_is_nacked(self):
+		handler, conn = self.make_handler(prefetch=1)
+		failed = conn.deliver(json.dumps({'batch': [['fail-later'], ['ok']]}))
+		self.assertTrue(conn.wait_for(lambda: conn.nacked))
+		self.assertEqual(conn.nacked, [failed])
+		self.assertEqual(conn.acked, [])
+		self.assertEqual(handler.n_failed, 1)
+	def test_job_failing_after_done_is_counted_once(self):
+		handler, conn = self.make_handler(prefetch=1, n_workers=1)
+		first = conn.deliver(json.dumps({'batch': [['done-then-fail'], ['wait']]}))
+		self.assertTrue(conn.wait_for(lambda: handler.n_failed == 1))
+		# The second job is still running, so the message must not
+		# have been acknowledged on the strength of the first one
+		# counting twice
+		self.assertFalse(conn.wait_for(lambda: conn.acked, timeout=0.2))
+		handler.release.set()
+		self.assertTrue(conn.wait_for(lambda: conn.acked))
+		self.assertEqual(conn.acked, [first])
+		self.assertEqual(conn.nacked, [])
+	def test_unreadable_message_is_acked(self):
+		handler, conn = self.make_handler(prefetch=1)
+		bad = conn.deliver('not json')
+		good = conn.deliver(json.dumps(['ok']))
+		self.assertTrue(conn.wait_for(lambda: len(conn.acked) == 2))
+		self.assertEqual(conn.acked, [bad, good])
+
+class FailingDatastore:
+	def __init__(self):
+		self.batches = []
+		self.down = True
+	def save_mp3_batch(self, entries, errors):
+		if self.down:
+			raise IOError('datastore is down')
+		self.batches.append(list(entries))
+		return len(entries)
+
+class Entry:
+	def __init__(self, path):
+		self.path = path
+
+class BufferedWriterTest(unittest.TestCase):
+	def test_failed_batch_is_not_kept(self):
+		for mod in (aflib2, aflib3):
+			datastore = FailingDatastore()
+			writer = mod.AFBufferedWriter(datastore, batch_size=2)
+			written = []
+			failed = []
+			writer.put(Entry('a'), lambda: written.append('a'),
+						lambda e: failed.append(('a', e)))
+			self.assertRaises(IOError, writer.put, Entry('b'),
+						lambda: written.append('b'), lambda e: failed.append(('b', e)))
+			self.assertEqual([path for path, e in failed], ['a', 'b'])
+			self.assertEqual([path for path, e in writer.failed], ['a', 'b'])
+			self.assertEqual(writer.buffer, [])
+			self.assertEqual(writer.callbacks, [])
+			datastore.down = False
+			writer.put(Entry('c'), lambda: written.append('c'))
+			writer.flush()
+			self.assertEqual(written, ['c'])
+			self.assertEqual([[e.path for e in batch] for batch in datastore.batches], [['c']])
+
+class AFMQTest(unittest.TestCase):
+	def setUp(self):
+		self.real_connection = afmq.stomp.Connection
+		afmq.stomp.Connection = StubConnection
+	def tearDown(self):
+		afmq.stomp.Connection = self.real_connection
+	def sent_batches(self, conn):
+		batches = []
+		for destination, body in conn.sent:
+			self.assertEqual(destination, '/test/queue')
+			batches.append(json.loads(body)['batch'])
+		return batches
+	def test_sends_full_batches(self):
+		mq = afmq.AFMQ('/test/queue', batch_size=3, linger_ms=10000)
+		conn = mq.queue_handle
+		for i in xrange(7):
+			mq.put([i])
+		self.assertEqual(self.sent_batches(conn), [[[0], [1], [2]], [[3], [4], [5]]])
+		self.assertEqual((mq.n_jobs, mq.n_messages), (6, 2))
+		mq.close()
+		self.assertEqual(self.sent_batches(conn)[-1], [[6]])
+		self.assertEqual((mq.n_jobs, mq.n_messages), (7, 3))
+		self.assertEqual(str(mq), 'Queued 7 jobs in 3 messages to /test/queue')
+	def test_sends_batch_once_linger_time_has_passed(self):
+		mq = afmq.AFMQ('/test/queue', batch_size=100, linger_ms=20)
+		conn = mq.queue_handle
+		mq.put(['a'])
+		self.assertEqual(conn.sent, [])
+		sleep(0.05)
+		mq.put(['b'])
+		self.assertEqual(self.sent_batches(conn), [[['a'], ['b']]])
+		mq.close()
+	def test_flush_sends_partial_batch(self):
+		mq = afmq.AFMQ('/test/queue', batch_size=100, linger_ms=10000)
+		conn = mq.queue_handle
+		mq.flush()
+		self.assertEqual(conn.sent, [])
+		mq.put(['a'])
+		mq.put(['b'])
+		mq.flush()
+		self.assertEqual(self.sent_batches(conn), [[['a'], ['b']]])
+		mq.flush()
+		self.assertEqual(mq.n_messages, 1)
+		mq.close()
+		# Closing twice does nothing
+		mq.close()
+		self.assertEqual(mq.n_messages, 1)
+		self.assertFalse(conn.running)
+	def test_single_job_batches(self):
+		mq = afmq.AFMQ('/test/queue')
+		conn = mq.queue_handle
+		mq.put(['a', 1])
+		mq.put(['b', 2])
+		self.assertEqual(self.sent_batches(conn), [[['a', 1]], [['b', 2]]])
+		mq.close()
+
+class FakeLibrary:
+	def __init__(self):
+		self.updates = []
+		self.down = False
+	def update_paths(self, moves):
+		if self.down:
+			raise IOError('datastore is down')
+		self.updates.append(list(moves))
+
+class RenameFileHandlerTest(unittest.TestCase):
+	def setUp(self):
+		self.real_connection = afmq.stomp.Connection
+		self.real_planner = afmq.RenamePlanner
+		self.root = tempfile.mkdtemp()
+		self.journal_path = os.path.join(self.root, 'rename.journal')
+		afmq.stomp.Connection = StubConnection
+		afmq.RenamePlanner = partial(RenamePlanner, journal_path=self.journal_path)
+		self.aflib = FakeLibrary()
+		self.handler = None
+	def tearDown(self):
+		if self.handler:
+			self.handler.close()
+		afmq.stomp.Connection = self.real_connection
+		afmq.RenamePlanner = self.real_planner
+		shutil.rmtree(self.root)
+	def start(self):
+		self.handler = afmq.RenameFileHandler(self.aflib)
+		return self.handler.queue_handle
+	def make_song(self, title):
+		path = os.path.join(self.root, 'old-%s.mp3' % title)
+		open(path, 'wb').close()
+		return {'path': path, 'base_path': self.root, 'title': title}
+	def new_path(self, title):
+		return os.path.join(self.root, '%s.mp3' % title)
+	def test_message_recorded_in_one_update(self):
+		songs = [self.make_song(t) for t in ('a', 'b', 'c')]
+		conn = self.start()
+		message_id = conn.deliver(json.dumps({'batch': [[song, '%t.mp3'] for song in songs]}))
+		self.assertTrue(conn.wait_for(lambda: conn.acked))
+		self.assertEqual(conn.acked, [message_id])
+		self.assertEqual(len(self.aflib.updates), 1)
+		self.assertEqual(sorted(self.aflib.updates[0]),
+					[(song['path'], self.new_path(song['title'])) for song in songs])
+		for song in songs:
+			self.assertTrue(os.path.exists(self.new_path(song['title'])))
+	def test_journaled_rename_recorded_on_redelivery(self):
+		# An earlier handler renamed the file, but went away before
+		# recording the new path
+		song = self.make_song('a')
+		with open(self.journal_path, 'wb') as f:
+			f.write('%s\t%s\n' % (song['path'], self.new_path('a')))
+		os.rename(song['path'], self.new_path('a'))
+		conn = self.start()
+		message_id = conn.deliver(json.dumps([song, '%t.mp3']))
+		self.assertTrue(conn.wait_for(lambda: conn.acked))
+		self.assertEqual(conn.acked, [message_id])
+		self.assertEqual(self.aflib.updates, [[(song['path'], self.new_path('a'))]])
+	def test_unrecorded_rename_is_nacked_and_journal_kept(self):
+		song = self.make_song('a')
+		body = json.dumps([song, '%t.mp3'])
+		conn = self.start()
+		self.aflib.down = True
+		first = conn.deliver(body)
+		self.assertTrue(conn.wait_for(lambda: conn.nacked))
+		self.assertEqual(conn.nacked, [first])
+		self.assertTrue(os.path.exists(self.new_path('a')))
+		# The broker redelivers it once the datastore is back
+		self.aflib.down = False
+		second = conn.deliver(body)
+		self.assertTrue(conn.wait_for(lambda: conn.acked))
+		self.assertEqual(conn.acked, [second])
+		self.assertEqual(self.aflib.updates, [[(song['path'], self.new_path('a'))]])
+		self.handler.close()
+		self.handler = None
+		self.assertTrue(os.path.exists(self.journal_path))
+
+class RoundTripTest(unittest.TestCase):
+	'''Posts jobs with AFMQ and hands the messages it sends to the
+	handlers, as the broker would.'''
+	def setUp(self):
+		self.real_connection = afmq.stomp.Connection
+		self.real_planner = afmq.RenamePlanner
+		self.root = tempfile.mkdtemp()
+		afmq.stomp.Connection = StubConnection
+		afmq.RenamePlanner = partial(RenamePlanner,
+						journal_path=os.path.join(self.root, 'rename.journal'))
+		self.handlers = []
+	def tearDown(self):
+		for handler in self.handlers:
+			handler.close()
+		afmq.stomp.Connection = self.real_connection
+		afmq.RenamePlanner = self.real_planner
+		shutil.rmtree(self.root)
+	def write_mp3(self, title):
+		path = os.path.join(self.root, '%s.mp3' % title)
+		with open(path, 'wb') as f:
+			f.write(make_tag(3, [('TIT2', title), ('TPE1', 'Scorpions'),
+						('TALB', 'Blackout'), ('TCON', '(17)'), ('TPUB', 'Harvest'),
+						('TYER', '1982')]) + AUDIO)
+		return path
+	def post(self, queue_name, jobs, conn):
+		mq = afmq.AFMQ(queue_name, batch_size=2)
+		sent = mq.queue_handle.sent
+		for job in jobs:
+			mq.put(job)
+		mq.close()
+		message_ids = []
+		for destination, body in sent:
+			self.assertEqual(destination, queue_name)
+			message_ids.append(conn.deliver(body))
+		return message_ids
+	def test_add_files(self):
+		paths = [self.write_mp3(title) for title in ('Blackout', 'Arizona', 'China White')]
+		datastore = aflib3.AFMemoryDataStore()
+		lib = aflib3.AFLibrary(datastore, aflib3.AFBufferedWriter(datastore, batch_size=3))
+		handler = afmq.AddFileHandler(lib, n_workers=2)
+		self.handlers.append(handler)
+		conn = handler.queue_handle
+		message_ids = self.post('/audiofile/library_additions',
+					[[path, self.root] for path in paths], conn)
+		self.assertEqual(len(message_ids), 2)
+		self.assertTrue(conn.wait_for(lambda: len(conn.acked) == 2))
+		self.assertEqual(sorted(conn.acked), sorted(message_ids))
+		songs = list(lib.get_songs(None))
+		self.assertEqual(sorted([song.path for song in songs]), sorted(paths))
+		self.assertEqual(sorted([song.title for song in songs]),
+					['Arizona', 'Blackout', 'China White'])
+	def test_rename_files(self):
+		lib = aflib3.AFLibrary(aflib3.AFMemoryDataStore())
+		for title in ('Blackout', 'Arizona', 'China White'):
+			lib.add_mp3(self.write_mp3(title), self.root)
+		handler = afmq.RenameFileHandler(lib)
+		self.handlers.append(handler)
+		conn = handler.queue_handle
+		message_ids = self.post('/audiofile/file_renames',
+					[[song.to_dict(), '%a/%t.mp3'] for song in lib.get_songs(None)], conn)
+		self.assertTrue(conn.wait_for(lambda: len(conn.acked) == 2))
+		self.assertEqual(sorted(conn.acked), sorted(message_ids))
+		expected = sorted([os.path.join(self.root, 'Scorpions', '%s.mp3' % title)
+					for title in ('Blackout', 'Arizona', 'China White')])
+		self.assertEqual(sorted([song.path for song in lib.get_songs(None)]), expected)
+		for path in expected:
+			self.assertTrue(os.path.exists(path))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_afutils.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import unittest
+
+import afutils
+from afutils import find_files_with_ext
+from aflib2 import AFLibrary, AFMemoryDataStore, AFLibraryEntry, get_file_fingerprint
+
+class WalkerTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.real_scandir = afutils.scandir
+		self.real_listdir = afutils.listdir
+		self.files = []
+		for name in ['a.mp3', 'b.MP3', 'c.flac', 'd.txt', '.hidden.mp3',
+					'x/e.mp3', 'x/y/f.mp3', 'x/y/g.Flac', 'z/h.mp3']:
+			self.touch(name)
+		os.symlink(os.path.join(self.tmpdir, 'x'), os.path.join(self.tmpdir, 'link'))
+	def tearDown(self):
+		afutils.scandir = self.real_scandir
+		afutils.listdir = self.real_listdir
+		shutil.rmtree(self.tmpdir)
+	def touch(self, name):
+		path = os.path.join(self.tmpdir, name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		open(path, 'w').close()
+		return path
+	def expected(self, *names):
+		return sorted([os.path.join(self.tmpdir, name) for name in names])
+	def fail_listing(self, name, error=errno.EIO):
+		'''Makes listing the directory name fail with error.'''
+		bad = os.path.join(self.tmpdir, name)
+		def failing(real):
+			def list_dir(dirname):
+				if dirname == bad:
+					raise OSError(error, os.strerror(error), dirname)
+				return real(dirname)
+			return list_dir
+		if afutils.scandir:
+			afutils.scandir = failing(self.real_scandir)
+		else:
+			afutils.listdir = failing(self.real_listdir)
+	def test_finds_extensions(self):
+		for n_workers in (1, 4):
+			self.assertEqual(sorted(find_files_with_ext(self.tmpdir, 'mp3', n_workers)),
+						self.expected('a.mp3', 'b.MP3', 'x/e.mp3', 'x/y/f.mp3', 'z/h.mp3'))
+			self.assertEqual(sorted(find_files_with_ext(self.tmpdir, ['.flac', 'txt'], n_workers)),
+						self.expected('c.flac', 'd.txt', 'x/y/g.Flac'))
+	def test_listing_error_reaches_caller(self):
+		self.fail_listing('x')
+		for n_workers in (1, 4):
+			found = []
+			try:
+				for path in find_files_with_ext(self.tmpdir, 'mp3', n_workers):
+					found.append(path)
+			except OSError as e:
+				self.assertEqual(e.errno, errno.EIO)
+			else:
+				self.fail('no error with %d workers' % n_workers)
+	def test_vanished_directory_is_empty(self):
+		self.fail_listing('x', errno.ENOENT)
+		for n_workers in (1, 4):
+			self.assertEqual(sorted(find_files_with_ext(self.tmpdir, 'mp3', n_workers)),
+						self.expected('a.mp3', 'b.MP3', 'z/h.mp3'))
+	def test_early_close_stops_threads(self):
+		before = threading.active_count()
+		files = find_files_with_ext(self.tmpdir, 'mp3', 4)
+		next(files)
+		files.close()
+		self.assertEqual(threading.active_count(), before)
+
+class FindChangedFilesTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.lib = AFLibrary(AFMemoryDataStore())
+		self.paths = []
+		for i in xrange(4):
+			path = os.path.join(self.tmpdir, '%d.mp3' % i)
+			open(path, 'w').close()
+			ent = AFLibraryEntry()
+			ent.title = 'Song %d' % i
+			ent.artist = ent.album = ent.genre = ent.publisher = 'X'
+			ent.path = path
+			ent.base_path = self.tmpdir
+			ent.size, ent.mtime, ent.inode = get_file_fingerprint(path)
+			self.lib.datastore.save_mp3(ent)
+			self.paths.append(path)
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def live(self):
+		return sorted([song.path for song in self.lib.get_songs(None)])
+	def test_missing_files_are_deleted(self):
+		os.remove(self.paths[3])
+		self.assertEqual(list(self.lib.find_changed_files(iter(self.paths[:3]), self.tmpdir)), [])
+		self.assertEqual(self.live(), self.paths[:3])
+	def test_scan_error_deletes_nothing(self):
+		def scan():
+			yield self.paths[0]
+			raise OSError(errno.EIO, 'Input/output error')
+		changed = self.lib.find_changed_files(scan(), self.tmpdir)
+		self.assertRaises(OSError, list, changed)
+		self.assertEqual(self.live(), self.paths)
+
+if __name__ == '__main__':
+	unittest.main()
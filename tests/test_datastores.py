@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_datastores.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Runs the same checks against every datastore in the aflib2 and
+# aflib3 registries.  Expected results are worked out here from the
+# songs saved, so a datastore registered later is checked as soon
+# as it is added to a registry.
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import defaultdict
+
+import sqlite3
+
+import aflib
+import aflib2
+import aflib3
+from test_mongo import get_client, get_server, TEST_DB
+
+# album -> (artist, year, publisher, total tracks, total discs); the
+# album details are stored once per album, so its songs share them
+ALBUMS = {
+	u'Blue': (u'Alpha', u'1990', u'EMI', 12, 1),
+	u'Red': (u'Alpha', u'1991', u'Sony', 10, 2),
+	u'Live': (u'Beta', u'1990', u'EMI', None, 1),
+	u'Caf\xe9': (u'Gamma', u'', u'Sony', 8, 2),
+	u'Gold': (u'Beta', u'1999', u'(Unknown)', 12, 1)
+}
+GENRES = [u'Rock', u'Pop', u'Jazz']
+
+def make_songs(mod):
+	songs = []
+	for i, album in enumerate(sorted(ALBUMS) * 8):
+		artist, year, publisher, total_tracks, total_discs = ALBUMS[album]
+		ent = mod.AFLibraryEntry()
+		ent.title = u'Song %02d' % i
+		ent.album = album
+		ent.artist = artist
+		ent.year = year
+		ent.publisher = publisher
+		ent.total_tracks = total_tracks
+		ent.total_discs = total_discs
+		ent.genre = GENRES[i % 3]
+		# Plenty of ties, and a few missing track numbers
+		ent.track_num = None if i % 11 == 0 else i % 4 + 1
+		ent.disc_num = i % total_discs + 1
+		ent.base_path = u'/music/%d' % (i % 2)
+		ent.path = u'%s/%02d.mp3' % (ent.base_path, i)
+		ent.size = i
+		ent.mtime = float(i)
+		ent.inode = 100 + i
+		songs.append(ent)
+	return songs
+
+class DatastoreConformance:
+	'''Checks for one datastore; subclasses set mod, the aflib
+	module, and name, the datastore's registered name.'''
+	mod = None
+	name = None
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.ds = self.make_datastore()
+		self.ds.create_db()
+		self.songs = make_songs(self.mod)
+		errors = []
+		self.assertEqual(self.ds.save_mp3_batch(self.songs, errors), len(self.songs))
+		self.assertEqual(errors, [])
+	def tearDown(self):
+		if self.name == 'mongo':
+			self.ds.client.drop_database(TEST_DB)
+		shutil.rmtree(self.tmpdir)
+	def make_datastore(self):
+		cls = self.mod.datastores[self.name]
+		if self.name == 'sqlite':
+			return cls(dbname=os.path.join(self.tmpdir, 'lib.db'))
+		if self.name == 'mongo':
+			client = get_client()
+			if client is None:
+				self.skipTest('needs a local mongod or mongomock')
+			return cls(dbname=TEST_DB, client=client)
+		return cls()
+	def query(self, qdict=None, **paging):
+		return list(self.ds.get_query_result_set(qdict, **paging))
+	def sort_key(self, order_by):
+		def key(song):
+			values = []
+			for name in order_by:
+				value = song[name.lstrip('-')] if isinstance(song, dict) else getattr(song, name.lstrip('-'))
+				values.append(value)
+			return values
+		return key
+	def expected_keys(self, songs, order_by):
+		# One stable sort per key, least significant first, as None
+		# sorts first going up
+		songs = list(songs)
+		for name in reversed(order_by):
+			songs.sort(key=lambda s: getattr(s, name.lstrip('-')), reverse=name.startswith('-'))
+		return [self.sort_key(order_by)(s) for s in songs]
+	def keyset_pages(self, qdict, order_by, limit):
+		results = []
+		after = None
+		while True:
+			page = self.query(qdict, order_by=order_by, limit=limit, after=after)
+			if not page:
+				return results
+			self.assertTrue(len(page) <= limit)
+			results.extend(page)
+			after = self.ds.get_page_key(page[-1], order_by)
+	def test_queries(self):
+		for qdict in [{}, {'artist': u'Alpha'}, {'album': u'Caf\xe9'}, {'genre': u'Jazz'},
+					{'publisher': u'EMI', 'genre': u'Rock'}, {'year': u'1990'},
+					{'base_path': u'/music/1'}, {'artist': u'Nobody'}]:
+			expected = [s.path for s in self.songs
+						if all([getattr(s, k) == v for k, v in qdict.items()])]
+			self.assertEqual(sorted([r['path'] for r in self.query(qdict)]), sorted(expected), qdict)
+	def test_results(self):
+		by_path = dict([(s.path, s) for s in self.songs])
+		for result in self.query({'artist': u'Beta'}):
+			song = by_path[result['path']]
+			for field in self.mod.AFLibraryEntry.row_fields:
+				if field != 'id':
+					self.assertEqual(result[field], getattr(song, field), field)
+			self.assertTrue(result['id'] is not None)
+	def test_ordering(self):
+		for qdict in [{}, {'artist': u'Alpha'}]:
+			songs = [s for s in self.songs if all([getattr(s, k) == v for k, v in qdict.items()])]
+			for order_by in [['title'], ['-title'], ['artist', 'disc_num', 'track_num'],
+						['-year', 'track_num'], ['genre', '-track_num'], ['album', '-path']]:
+				results = self.query(qdict, order_by=order_by)
+				self.assertEqual([self.sort_key(order_by)(r) for r in results],
+							self.expected_keys(songs, order_by), (qdict, order_by))
+	def test_paging(self):
+		for order_by in [None, ['genre'], ['artist', 'disc_num', 'track_num'], ['-track_num', 'album']]:
+			ids = [r['id'] for r in self.query({}, order_by=order_by, limit=1000)]
+			self.assertEqual(len(set(ids)), len(self.songs))
+			# The order is total, so every way of paging agrees
+			if order_by:
+				self.assertEqual([r['id'] for r in self.query({}, order_by=order_by)], ids)
+			offset_pages = []
+			for offset in xrange(0, len(self.songs), 7):
+				offset_pages.extend(self.query({}, order_by=order_by, limit=7, offset=offset))
+			self.assertEqual([r['id'] for r in offset_pages], ids, order_by)
+			self.assertEqual([r['id'] for r in self.keyset_pages({}, order_by, 7)], ids, order_by)
+			# A page key made from an entry works as well as one
+			# made from a result
+			entries = list(self.ds.get_entries({}, order_by=order_by, limit=5))
+			page = self.query({}, order_by=order_by, limit=5,
+						after=self.ds.get_page_key(entries[-1], order_by))
+			self.assertEqual([r['id'] for r in page], ids[5:10])
+	def test_paging_with_shared_paths(self):
+		if self.name == 'mongo':
+			self.skipTest('paths are unique in MongoDB')
+		# Renames onto one path leave several songs sharing it
+		target = self.songs[0].path
+		moves = [(s.path, target) for s in self.songs[1:4]]
+		self.ds.update_paths(moves)
+		results = self.query({}, order_by=['path'])
+		self.assertEqual(len(results), len(self.songs))
+		self.assertEqual([r['path'] for r in results].count(target), 4)
+		ids = [r['id'] for r in results]
+		for limit in (1, 2, 3):
+			self.assertEqual([r['id'] for r in self.keyset_pages({}, ['path'], limit)], ids)
+			self.assertEqual([r['id'] for r in self.keyset_pages({}, ['-path'], limit)],
+						[r['id'] for r in self.query({}, order_by=['-path'])])
+	def test_delete_and_move(self):
+		gone = [s.path for s in self.songs[:5]]
+		self.ds.delete_paths(gone + [u'/not/there.mp3'])
+		paths = set([r['path'] for r in self.query({})])
+		self.assertEqual(paths, set([s.path for s in self.songs[5:]]))
+		self.assertEqual(len(self.keyset_pages({}, ['track_num'], 4)), len(self.songs) - 5)
+		moved = self.songs[5].path
+		self.ds.update_paths([(moved, u'/music/new.mp3')])
+		paths = set([r['path'] for r in self.query({})])
+		self.assertTrue(u'/music/new.mp3' in paths and moved not in paths)
+		# Saving a deleted song again brings it back
+		self.ds.save_mp3_batch(self.songs[:2])
+		self.assertEqual(len(self.query({})), len(self.songs) - 3)
+	def test_fingerprints(self):
+		expected = dict([(s.path, (s.size, s.mtime, s.inode)) for s in self.songs
+						if s.base_path == u'/music/0'])
+		self.assertEqual(self.ds.get_file_fingerprints(u'/music/0'), expected)
+		self.assertEqual(self.ds.get_file_fingerprints(u'/elsewhere'), {})
+	def test_aggregate(self):
+		for group_by, qdict, distinct in [('genre', None, None), ('artist', None, 'album'),
+						(['artist', 'year'], None, None), ('album', {'genre': u'Pop'}, None),
+						('publisher', None, 'artist'), ('track_num', None, None)]:
+			fields = [group_by] if isinstance(group_by, basestring) else group_by
+			groups = defaultdict(set)
+			for s in self.songs:
+				if all([getattr(s, k) == v for k, v in (qdict or {}).items()]):
+					key = tuple([getattr(s, f) for f in fields])
+					groups[key].add(s.path if distinct is None else getattr(s, distinct))
+			expected = sorted([(-len(v),) + k for k, v in groups.items()])
+			results = self.ds.aggregate(group_by, qdict, distinct)
+			self.assertEqual(sorted([(-r['count'],) + tuple([r[f] for f in fields]) for r in results]),
+						expected, (group_by, qdict, distinct))
+			counts = [r['count'] for r in results]
+			self.assertEqual(counts, sorted(counts, reverse=True))
+	def search(self, text, limit=50):
+		return list(self.ds.search(text, limit))
+	def test_search(self):
+		if self.name == 'mongo' and get_server() is None:
+			self.skipTest('text search needs a local mongod')
+		gold = sorted([s.path for s in self.songs if s.album == u'Gold'])
+		self.assertEqual(sorted([r['path'] for r in self.search(u'gold')]), gold)
+		by_path = dict([(s.path, s) for s in self.songs])
+		for result in self.search(u'Beta'):
+			self.assertEqual(result['artist'], u'Beta')
+			song = by_path[result['path']]
+			for field in self.mod.AFLibraryEntry.row_fields:
+				if field != 'id':
+					self.assertEqual(result[field], getattr(song, field), field)
+		self.assertEqual(len(self.search(u'song', limit=5)), 5)
+		self.assertEqual(self.search(u'nowhere'), [])
+		self.ds.delete_paths(gold[:3])
+		self.assertEqual(sorted([r['path'] for r in self.search(u'gold')]), gold[3:])
+	def test_search_words(self):
+		if self.name == 'mongo':
+			self.skipTest('MongoDB matches any whole word')
+		# Every word must match, each as the start of a word
+		expected = sorted([s.path for s in self.songs if s.album == u'Gold' or
+					(s.album == u'Live' and s.artist == u'Beta')])
+		self.assertEqual(sorted([r['path'] for r in self.search(u'bet')]), expected)
+		self.assertEqual(sorted([r['path'] for r in self.search(u'bet liv')]),
+					sorted([s.path for s in self.songs if s.album == u'Live']))
+		self.assertEqual([r['title'] for r in self.search(u'song 07')], [u'Song 07'])
+		self.assertEqual(self.search(u'eta'), [])
+		self.assertEqual(self.search(u'  '), [])
+		# Accents are ignored on both sides
+		cafe = sorted([s.path for s in self.songs if s.album == u'Caf\xe9'])
+		for text in (u'cafe', u'CAF\xc9', 'caf\xc3\xa9'):
+			self.assertEqual(sorted([r['path'] for r in self.search(text)]), cafe, text)
+	def test_unknown_fields(self):
+		self.assertRaises(ValueError, self.query, {}, order_by=['bogus'])
+		self.assertRaises(ValueError, self.ds.aggregate, 'bogus')
+
+class SqliteUpgradeTest(unittest.TestCase):
+	'''A library written by the original schema, without the file
+	fingerprint columns, is usable without running create_db().'''
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+	def make_library(self, name):
+		dbname = os.path.join(self.tmpdir, name)
+		con = sqlite3.connect(dbname)
+		aflib.AFLibrary.create_db.im_func(None, con)
+		con.executescript('''
+			INSERT INTO publisher(id, name) VALUES (1, 'EMI');
+			INSERT INTO genre(id, name) VALUES (1, 'Rock');
+			INSERT INTO artist(id, name) VALUES (1, 'Scorpions');
+			INSERT INTO album(id, name, artist_id, track_count, disc_count, publisher_id, year) VALUES (1, 'Blackout', 1, 9, 1, 1, '1982');
+			INSERT INTO song(name, path, base_path, album_id, artist_id, genre_id, track_num, disc_num) VALUES ('Arizona', '/music/a.mp3', '/music', 1, 1, 1, 7, 1);
+		''')
+		con.commit()
+		con.close()
+		return dbname
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def test_old_library(self):
+		for mod in (aflib2, aflib3):
+			ds = mod.AFSqliteDataStore(dbname=self.make_library('%s.db' % mod.__name__))
+			self.assertEqual([r['title'] for r in ds.get_query_result_set({'artist': 'Scorpions'})], [u'Arizona'])
+			self.assertEqual([r['path'] for r in ds.search('ariz')], [u'/music/a.mp3'])
+			self.assertEqual(ds.aggregate('genre'), [{'genre': u'Rock', 'count': 1}])
+			self.assertEqual(ds.get_file_fingerprints('/music'), {u'/music/a.mp3': (None, None, None)})
+			ds.delete_paths(['/music/a.mp3'])
+			self.assertEqual(list(ds.get_query_result_set({})), [])
+			ds.close()
+
+# One TestCase per registered datastore
+for mod in (aflib2, aflib3):
+	for name in mod.datastores:
+		test_name = 'Test%s%sDatastore' % (mod.__name__.capitalize(), name.capitalize())
+		globals()[test_name] = type(test_name, (DatastoreConformance, unittest.TestCase),
+						{'mod': mod, 'name': name})
+
+if __name__ == '__main__':
+	unittest.main()
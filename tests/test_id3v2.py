@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_id3v2.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+import subprocess
+import unittest
+
+from afutils import id3v2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A silent MPEG-1 layer III frame, so eyed3 sees some audio
+AUDIO = '\xff\xfb\x90\x00' + '\x00' * 413
+
+FRAMES = [('TIT2', 'Arizona'), ('TPE1', 'Scorpions'), ('TALB', 'Blackout'),
+	('TCON', '(17)'), ('TRCK', '7/9'), ('TPOS', '1/2'), ('TPUB', 'Harvest')]
+
+def syncsafe(n):
+	return ''.join([chr((n >> shift) & 0x7f) for shift in (21, 14, 7, 0)])
+
+def make_frame(version, frame_id, text, flags='\x00\x00'):
+	body = '\x00' + text
+	if version == 4:
+		size = syncsafe(len(body))
+	else:
+		size = struct.pack('>I', len(body))
+	return frame_id + size + flags + body
+
+def make_tag(version, frames):
+	data = ''.join([make_frame(version, *frame) for frame in frames])
+	return 'ID3' + chr(version) + '\x00\x00' + syncsafe(len(data)) + data
+
+# Reads a file in a process of its own, as the tag reading pool and
+# the queue handlers do, so nothing loaded by this process (or by
+# eyed3.load()) can hide a missing import
+READ_SCRIPT = '''
+import sys, json
+mod = __import__(sys.argv[1])
+ent = mod.AFLibraryEntry()
+ent.apply_path(sys.argv[2], sys.argv[3])
+print json.dumps(dict([(f, getattr(ent, f)) for f in ('title', 'artist',
+	'album', 'genre', 'track_num', 'total_tracks', 'disc_num',
+	'total_discs', 'publisher', 'year')]))
+'''
+
+class ID3v2Test(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def write(self, name, data):
+		path = os.path.join(self.tmpdir, name)
+		with open(path, 'wb') as f:
+			f.write(data + AUDIO)
+		return path
+	def read_in_process(self, mod, path):
+		env = dict(os.environ)
+		env['PYTHONPATH'] = ROOT
+		out = subprocess.check_output([sys.executable, '-c', READ_SCRIPT,
+						mod, path, self.tmpdir], env=env)
+		return json.loads(out.strip().splitlines()[-1])
+	def check_tags(self, tags, year):
+		self.assertEqual(tags['title'], 'Arizona')
+		self.assertEqual(tags['artist'], 'Scorpions')
+		self.assertEqual(tags['album'], 'Blackout')
+		self.assertEqual(tags['genre'], 'Rock')
+		self.assertEqual((tags['track_num'], tags['total_tracks']), (7, 9))
+		self.assertEqual((tags['disc_num'], tags['total_discs']), (1, 2))
+		self.assertEqual(tags['publisher'], 'Harvest')
+		self.assertEqual(tags['year'], year)
+	def test_reads_v23_frames(self):
+		path = self.write('v23.mp3', make_tag(3, FRAMES + [('TYER', '1982')]))
+		frames = id3v2.read_frames(path)
+		self.assertEqual(frames['TIT2'], 'Arizona')
+		self.assertEqual(frames['TCON'], '(17)')
+		for mod in ('aflib2', 'aflib3'):
+			self.check_tags(self.read_in_process(mod, path), '1982')
+	def test_reads_v24_frames(self):
+		path = self.write('v24.mp3', make_tag(4, FRAMES + [('TDRC', '1982')]))
+		self.assertEqual(id3v2.read_frames(path)['TDRC'], '1982')
+		for mod in ('aflib2', 'aflib3'):
+			self.check_tags(self.read_in_process(mod, path), '1982')
+	def test_grouped_frames_fall_back_to_eyed3(self):
+		frames = [frame for frame in FRAMES if frame[0] != 'TCON'] + [('TDRC', '1982')]
+		data = ''.join([make_frame(4, *frame) for frame in frames])
+		# A genre frame with the grouping flag set, so its text
+		# follows a group byte
+		body = '\x01\x00(17)'
+		data += 'TCON' + syncsafe(len(body)) + '\x00\x40' + body
+		data = 'ID3\x04\x00\x00' + syncsafe(len(data)) + data
+		path = self.write('grouped.mp3', data)
+		self.assertEqual(id3v2.read_frames(path), None)
+		self.check_tags(self.read_in_process('aflib2', path), '1982')
+	def test_no_tag(self):
+		path = self.write('none.mp3', '')
+		self.assertEqual(id3v2.read_frames(path), None)
+
+if __name__ == '__main__':
+	unittest.main()
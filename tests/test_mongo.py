@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_mongo.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+import pymongo
+import pymongo.errors
+from aflib3 import AFMongoDataStore, AFLibraryEntry
+
+TEST_DB = 'audiofile_test'
+
+def get_server():
+	'''Returns a client for a mongod on localhost, or None.'''
+	client = pymongo.MongoClient(serverSelectionTimeoutMS=200)
+	try:
+		client.server_info()
+	except pymongo.errors.PyMongoError:
+		return None
+	return client
+
+def get_client():
+	'''Returns a client for a mongod on localhost, or failing
+	that a mongomock stand-in, or None if neither is available.'''
+	client = get_server()
+	if client is not None:
+		return client
+	try:
+		import mongomock
+	except ImportError:
+		return None
+	return mongomock.MongoClient()
+
+def make_entry(i, **tags):
+	ent = AFLibraryEntry()
+	ent.title = u'Song %d' % i
+	ent.artist = u'Artist %d' % (i % 3)
+	ent.album = u'Album %d' % (i % 5)
+	ent.genre = u'Rock'
+	ent.publisher = u'EMI'
+	ent.year = u'1990'
+	ent.track_num = i % 7 + 1
+	ent.disc_num = 1
+	ent.base_path = u'/music'
+	ent.path = u'/music/%03d.mp3' % i
+	for name, value in tags.items():
+		setattr(ent, name, value)
+	return ent
+
+class MongoDataStoreTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.client = get_client()
+		cls.server = isinstance(cls.client, pymongo.MongoClient)
+	def setUp(self):
+		client = self.client
+		if client is None:
+			self.skipTest('needs a local mongod or mongomock')
+		self.ds = AFMongoDataStore(dbname=TEST_DB, client=client)
+		self.ds.create_db()
+		self.songs = client[TEST_DB].songs
+	def tearDown(self):
+		self.ds.client.drop_database(TEST_DB)
+	def paths(self, qdict=None, **paging):
+		return [r['path'] for r in self.ds.get_query_result_set(qdict, **paging)]
+	def test_batches_upsert_on_path(self):
+		# 47 adds of 40 files, as a redelivered queue message would
+		# send some of them again
+		entries = [make_entry(i % 40) for i in xrange(47)]
+		for i in xrange(0, len(entries), 5):
+			self.assertEqual(self.ds.save_mp3_batch(entries[i:i + 5]), len(entries[i:i + 5]))
+		self.assertEqual(self.songs.count_documents({}), 40)
+	def test_save_replaces_song_at_path(self):
+		self.ds.save_mp3(make_entry(1))
+		self.ds.save_mp3(make_entry(1, genre=u'Jazz'))
+		self.assertEqual(self.songs.count_documents({}), 1)
+		self.assertEqual([r['genre'] for r in self.ds.get_query_result_set({})], [u'Jazz'])
+	def test_batch_reports_failed_entries(self):
+		self.songs.create_index([('title', pymongo.ASCENDING)], name='unique_title', unique=True)
+		entries = [make_entry(1), make_entry(2, title=u'Song 1'), make_entry(3)]
+		errors = []
+		self.assertEqual(self.ds.save_mp3_batch(entries, errors), 2)
+		self.assertEqual([entry.path for entry, e in errors], [entries[1].path])
+		self.assertTrue(isinstance(errors[0][1], pymongo.errors.WriteError))
+		self.assertEqual(sorted(self.paths()), [entries[0].path, entries[2].path])
+		# Without an errors list the failure is raised, once the
+		# rest of the batch is saved
+		self.assertRaises(pymongo.errors.WriteError, self.ds.save_mp3_batch,
+						[make_entry(4), make_entry(5, title=u'Song 1')])
+		self.assertTrue(make_entry(4).path in self.paths())
+	def test_results_carry_id(self):
+		self.ds.save_mp3(make_entry(1))
+		result = list(self.ds.get_query_result_set({}))[0]
+		self.assertEqual(result['id'], self.songs.find_one({})['_id'])
+		self.assertFalse('_id' in result)
+		self.assertFalse('id' in self.songs.find_one({}))
+	def test_delete_and_move(self):
+		self.ds.save_mp3_batch([make_entry(i) for i in xrange(4)])
+		self.ds.delete_paths([make_entry(0).path])
+		self.assertEqual(len(self.paths()), 3)
+		# A rename onto a deleted song's path replaces the tombstone
+		self.ds.update_paths([(make_entry(1).path, make_entry(0).path)])
+		self.assertEqual(sorted(self.paths()), [make_entry(i).path for i in (0, 2, 3)])
+		self.assertEqual(self.songs.count_documents({}), 3)
+	def test_keyset_pages_cover_every_song(self):
+		self.ds.save_mp3_batch([make_entry(i) for i in xrange(30)])
+		order_by = ['disc_num', 'track_num']
+		expected = self.paths({'artist': u'Artist 1'}, order_by=order_by)
+		pages = []
+		after = None
+		while True:
+			page = list(self.ds.get_query_result_set({'artist': u'Artist 1'},
+							order_by=order_by, limit=3, after=after))
+			if not page:
+				break
+			pages.extend([r['path'] for r in page])
+			after = self.ds.get_page_key(page[-1], order_by)
+		self.assertEqual(pages, expected)
+		self.assertEqual(len(pages), 10)
+	def test_indexes(self):
+		names = set(self.songs.index_information())
+		for name, keys, unique in AFMongoDataStore.indexes:
+			self.assertTrue(name in names, name)
+		# Indexes replaced by newer ones are dropped
+		self.songs.create_index([('artist', pymongo.ASCENDING), ('path', pymongo.ASCENDING)],
+						name='artist_order')
+		self.ds.ensure_indexes()
+		self.assertFalse('artist_order' in self.songs.index_information())
+	def test_results_are_projected(self):
+		self.ds.save_mp3(make_entry(1, size=100, mtime=1.5, inode=7))
+		result = list(self.ds.get_query_result_set({}))[0]
+		self.assertEqual(set(result), set(AFLibraryEntry.row_fields))
+		result = list(self.ds.get_query_result_set({}, fields=['path']))[0]
+		self.assertEqual(set(result), set(['path']))
+	def test_query_plans_use_indexes(self):
+		if not self.server:
+			self.skipTest('explain needs a local mongod')
+		self.ds.save_mp3_batch([make_entry(i) for i in xrange(30)])
+		for qdict, order_by, index in [
+			({'artist': u'Artist 1'}, ['disc_num', 'track_num'], 'artist_page'),
+			({'album': u'Album 2'}, ['disc_num', 'track_num'], 'album_page'),
+			({'genre': u'Rock'}, None, 'genre'),
+			({'year': u'1990'}, None, 'year'),
+			({'base_path': u'/music'}, None, 'base_path'),
+			({'path': make_entry(3).path}, None, 'path')]:
+			if order_by:
+				steps = self.ds.explain_query(qdict, order_by=order_by, limit=5)
+				# Pages come back in index order, without a sort
+				self.assertFalse('SORT' in steps, (qdict, steps))
+			else:
+				steps = self.ds.explain_query(qdict)
+			self.assertTrue('IXSCAN %s' % index in steps, (qdict, steps))
+
+if __name__ == '__main__':
+	unittest.main()
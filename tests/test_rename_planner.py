@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_rename_planner.py
+
+The MIT License (MIT)
+
+Copyright (c) 2013 Matt Ryan
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from afutils import rename_planner
+from afutils.rename_planner import RenamePlanner
+
+class RenamePlannerTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.journal_path = os.path.join(self.tmpdir, 'journal', 'rename.journal')
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def path(self, name):
+		return os.path.join(self.tmpdir, name)
+	def touch(self, name, data=''):
+		path = self.path(name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'wb') as f:
+			f.write(data)
+		return path
+	def read(self, path):
+		with open(path, 'rb') as f:
+			return f.read()
+	def planner(self):
+		return RenamePlanner(self.journal_path)
+	def test_renames_planned_moves(self):
+		planner = self.planner()
+		a = self.touch('a.mp3', 'a')
+		self.assertTrue(planner.add(a, self.path('x/a.mp3')))
+		self.assertFalse(planner.add(self.path('b.mp3'), self.path('x/b.mp3')))
+		self.assertEqual(planner.missing, [self.path('b.mp3')])
+		self.assertEqual(planner.execute(2), [(a, self.path('x/a.mp3'))])
+		self.assertEqual(self.read(self.path('x/a.mp3')), 'a')
+		self.assertTrue(os.path.exists(self.journal_path))
+		planner.finish()
+		self.assertFalse(os.path.exists(self.journal_path))
+	def test_target_claimed_by_two_songs(self):
+		planner = self.planner()
+		a = self.touch('a.mp3', 'a')
+		b = self.touch('b.mp3', 'b')
+		c = self.touch('c.mp3', 'c')
+		target = self.path('x/song.mp3')
+		self.assertTrue(planner.add(a, target))
+		self.assertFalse(planner.add(b, target))
+		# A third claim is turned away as well
+		self.assertFalse(planner.add(c, target))
+		self.assertEqual(sorted([src for src, dst, reason in planner.collisions]), [a, b, c])
+		self.assertEqual(planner.execute(2), [])
+		# Neither song gets the target
+		self.assertFalse(os.path.exists(target))
+		for path, data in ((a, 'a'), (b, 'b'), (c, 'c')):
+			self.assertEqual(self.read(path), data)
+	def test_existing_target_is_left_alone(self):
+		planner = self.planner()
+		a = self.touch('a.mp3', 'a')
+		target = self.touch('x/a.mp3', 'existing')
+		self.assertFalse(planner.add(a, target))
+		self.assertEqual(planner.collisions, [(a, target, 'target already exists')])
+		# A target that turns up after planning is left alone too
+		b = self.touch('b.mp3', 'b')
+		late = self.path('x/b.mp3')
+		self.assertTrue(planner.add(b, late))
+		self.touch('x/b.mp3', 'late')
+		self.assertEqual(planner.execute(2), [])
+		self.assertEqual(planner.collisions[-1], (b, late, 'target already exists'))
+		self.assertEqual(self.read(target), 'existing')
+		self.assertEqual(self.read(late), 'late')
+		self.assertEqual(self.read(a), 'a')
+		self.assertEqual(self.read(b), 'b')
+	def test_noop(self):
+		planner = self.planner()
+		a = self.touch('a.mp3')
+		self.assertFalse(planner.add(a, a))
+		self.assertEqual(planner.noops, [a])
+	def test_resumes_from_journal(self):
+		a = self.touch('a.mp3', 'a')
+		b = self.touch('b.mp3', 'b')
+		# A run which was interrupted after moving a, but before
+		# recording it
+		planner = self.planner()
+		planner.add(a, self.path('x/a.mp3'))
+		planner.add(b, self.path('x/b.mp3'))
+		planner.execute(1)
+		os.rename(self.path('x/b.mp3'), b)
+		planner.journal.close()
+		planner.journal = None
+		planner = self.planner()
+		self.assertFalse(planner.add(a, self.path('x/a.mp3')))
+		self.assertTrue(planner.add(b, self.path('x/b.mp3')))
+		self.assertEqual(planner.missing, [])
+		self.assertEqual(sorted(planner.execute(2)),
+					[(a, self.path('x/a.mp3')), (b, self.path('x/b.mp3'))])
+		planner.finish()
+		self.assertFalse(os.path.exists(self.journal_path))
+		# Once finished the journal no longer vouches for the move
+		planner = self.planner()
+		self.assertFalse(planner.add(a, self.path('x/a.mp3')))
+		self.assertEqual(planner.missing, [a])
+		self.assertEqual(planner.completed, [])
+	def test_rename_reports_journaled_move(self):
+		a = self.touch('a.mp3', 'a')
+		target = self.path('x/a.mp3')
+		planner = self.planner()
+		self.assertTrue(planner.rename(a, target))
+		# Asking again, as a redelivered job would, still reports
+		# the move so that it can be recorded
+		self.assertTrue(planner.rename(a, target))
+		self.assertFalse(planner.rename(self.path('b.mp3'), self.path('x/b.mp3')))
+		planner.finish()
+	def test_journal_kept_after_failure(self):
+		a = self.touch('a.mp3', 'a')
+		b = self.touch('b.mp3', 'b')
+		planner = self.planner()
+		planner.add(a, self.path('x/a.mp3'))
+		planner.add(b, self.path('x/b.mp3'))
+		real_rename = rename_planner.os.rename
+		def rename(src, dst):
+			if src == b:
+				raise OSError(13, 'Permission denied')
+			real_rename(src, dst)
+		rename_planner.os.rename = rename
+		try:
+			self.assertEqual(planner.execute(2), [(a, self.path('x/a.mp3'))])
+		finally:
+			rename_planner.os.rename = real_rename
+		self.assertEqual([(src, dst) for src, dst, e in planner.failed], [(b, self.path('x/b.mp3'))])
+		planner.finish()
+		self.assertTrue(os.path.exists(self.journal_path))
+		# The next run picks up the move that was made and retries
+		# the one that wasn't
+		planner = self.planner()
+		self.assertFalse(planner.add(a, self.path('x/a.mp3')))
+		self.assertEqual(planner.completed, [(a, self.path('x/a.mp3'))])
+		self.assertTrue(planner.add(b, self.path('x/b.mp3')))
+	def test_journal_kept_for_unrecorded_moves(self):
+		a = self.touch('a.mp3', 'a')
+		planner = self.planner()
+		self.assertTrue(planner.rename(a, self.path('x/a.mp3')))
+		planner.unrecorded([(a, self.path('x/a.mp3'))])
+		planner.finish()
+		self.assertTrue(os.path.exists(self.journal_path))
+	def test_without_journal(self):
+		planner = RenamePlanner(None)
+		a = self.touch('a.mp3', 'a')
+		self.assertTrue(planner.rename(a, self.path('x/a.mp3')))
+		planner.finish()
+		self.assertFalse(os.path.exists(self.journal_path))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -26,53 +26,152 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
 from Queue import Queue
+from time import time
+
+class JobTimeoutError(Exception):
+	pass
+
+class Job:
+	'''Handle for a job submitted to a ThreadPool via submit().
+	result() waits for the job and returns what the action
+	returned, or raises whatever the action raised.'''
+	def __init__(self, data):
+		self.data = data
+		self.value = None
+		self.error = None
+		self.finished = Event()
+	def done(self):
+		return self.finished.is_set()
+	def result(self, timeout=None):
+		if not self.finished.wait(timeout):
+			raise JobTimeoutError
+		if self.error is not None:
+			raise self.error
+		return self.value
+	def exception(self, timeout=None):
+		if not self.finished.wait(timeout):
+			raise JobTimeoutError
+		return self.error
 
 class ThreadPool:
 	'''Implementation of a simple threadpool.
 	Creating the threadpool gets it started.
 	Put jobs into the threadpool via put() and an
 	available thread in the pool will perform the
-	job.  Stop the threadpool using quit().'''
-	pool = []
-	q_in = Queue()
-	q_out = Queue()
-	n_jobs = 0
-	action = None
+	job.  Stop the threadpool using quit().
+	Use submit() instead of put() to get a Job handle
+	for the result, map() to run the action over a list
+	of items, and drain() to wait for the queued jobs to
+	finish without stopping the pool.
+	The job queue holds at most max_queue jobs; once it
+	is full put() blocks until a thread takes a job.
+	Results are discarded unless a callback is supplied,
+	in which case callback(data, result) is called in the
+	worker thread after each job.'''
 	def run_thread(self):
 		while(True):
-			data = self.q_in.get()
-			if data[0]=='quit':
+			item = self.q_in.get()
+			if item is None:
 				break
-			else:
+			data, job = item
+			try:
+				result = None
 				if self.action is not None:
-					self.action(data)
-				self.q_out.put(data)
+					result = self.action(data)
+				if self.callback is not None:
+					self.callback(data, result)
+				if job is not None:
+					job.value = result
+			except Exception as e:
+				if job is not None:
+					job.error = e
+				else:
+					print 'ThreadPool job %s failed: %s' % (data, e)
+				with self.lock:
+					self.n_failed += 1
+			finally:
+				if job is not None:
+					job.finished.set()
+				with self.idle:
+					self.n_done += 1
+					if self.n_done == self.n_jobs:
+						self.idle.notify_all()
 	def quit(self):
+		if self.stopped:
+			return
+		self.stopped = True
 		for t in self.pool:
-			self.put(['quit'])
+			self.q_in.put(None)
 		for t in self.pool:
 			t.join()
-		for t in self.pool:
-			del t	
-	def __init__(self,action,n_threads=5):
+		self.pool = []
+	def __init__(self,action,n_threads=5,max_queue=100,callback=None):
 		self.action = action
+		self.callback = callback
+		self.q_in = Queue(max_queue)
+		self.lock = Lock()
+		self.idle = Condition(self.lock)
+		self.n_jobs = 0
+		self.n_done = 0
+		self.n_failed = 0
+		self.stopped = False
+		self.start_time = time()
+		self.pool = []
 		for i in xrange(n_threads):
 			t = Thread(target=self.run_thread)
 			t.start()
 			self.pool.append(t)
 	def __del__(self):
 		self.quit()
+	def _enqueue(self,data,job):
+		if self.stopped:
+			raise RuntimeError('ThreadPool has been stopped')
+		with self.lock:
+			self.n_jobs += 1
+		self.q_in.put((data, job))
 	def put(self,data):
-		self.n_jobs += 1
-		self.q_in.put(data)
+		self._enqueue(data, None)
+	def submit(self,data):
+		job = Job(data)
+		self._enqueue(data, job)
+		return job
+	def map(self,items,timeout=None):
+		jobs = [self.submit(data) for data in items]
+		return [job.result(timeout) for job in jobs]
+	def drain(self,timeout=None):
+		'''Waits until every job put into the pool so far has
+		finished.  Returns False if timeout seconds pass first.'''
+		deadline = None
+		if timeout is not None:
+			deadline = time() + timeout
+		with self.idle:
+			while self.n_done < self.n_jobs:
+				if deadline is None:
+					self.idle.wait()
+				else:
+					remaining = deadline - time()
+					if remaining <= 0:
+						return False
+					self.idle.wait(remaining)
+		return True
 	def total_jobs(self):
 		return self.n_jobs
 	def remaining_jobs(self):
-		return self.q_in.count()
+		return self.q_in.qsize()
 	def completed_jobs(self):
-		return self.q_out.count()
+		return self.n_done
+	def failed_jobs(self):
+		return self.n_failed
+	def jobs_per_sec(self):
+		elapsed = time() - self.start_time
+		if elapsed:
+			return self.n_done / elapsed
+		return 0.0
+	def __str__(self):
+		return '%d jobs submitted, %d queued, %d completed, %d failed (%.1f jobs/sec)' % \
+			(self.n_jobs, self.remaining_jobs(), self.n_done, self.n_failed, self.jobs_per_sec())
 		
 if __name__ == '__main__':
 	pass